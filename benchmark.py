@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of python-statsd-client released under the Apache
+# License, Version 2.0. See the NOTICE for more information.
+
+"""Micro-benchmarks for the statsd client.
+
+Run all of them, or only the named ones:
+
+    python benchmark.py
+    python benchmark.py null profiler
+"""
+
+from __future__ import absolute_import
+import sys
+import time
+import timeit
+
+NUMBER = 100000
+REPEAT = 5
+
+
+def _best(stmt, setup='pass', number=NUMBER):
+    """Return the best time of REPEAT runs of stmt, in microseconds per
+    call.
+    """
+    times = timeit.repeat(stmt, setup, number=number, repeat=REPEAT)
+    return min(times) * 1e6 / number
+
+
+def bench_null(out):
+    """Cost of the module helpers and a timer with stats disabled, next to
+    an empty function call and the same calls enabled.
+    """
+    empty = _best('empty("counted")', 'def empty(bucket): pass')
+    out.write('empty function call:        %6.2fus\n' % empty)
+    for enabled in (False, True):
+        setup = ('import statsd\n'
+                 'statsd.init_statsd({"STATSD_ENABLED": %r, "STATSD_PORT": 9})'
+                 % enabled)
+        label = 'enabled' if enabled else 'disabled'
+        increment = _best('statsd.increment("counted")', setup)
+        timer = _best('with statsd.StatsdTimer("timed"): pass', setup)
+        out.write('increment(), %-8s       %6.2fus (%.1fx empty)\n'
+                  % (label, increment, increment / empty))
+        out.write('StatsdTimer block, %-8s %6.2fus\n' % (label, timer))
+
+
+def bench_spool(out):
+    """Cost of spooling a stat, which takes a file lock, next to the
+    sendto it follows.
+    """
+    setup = ('import os, socket, tempfile, statsd\n'
+             'path = os.path.join(tempfile.mkdtemp(), "spool")\n'
+             'spool = statsd.StatsdSpool(path, size=1024 * 1024)\n'
+             'sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)')
+    sendto = _best('sock.sendto(b"bucket:1|c", ("127.0.0.1", 9))', setup)
+    append = _best('spool.append(b"bucket:1|c")', setup)
+    pop = _best('spool.append(b"bucket:1|c"); spool.pop()', setup) - append
+    out.write('sendto:                     %6.2fus\n' % sendto)
+    out.write('spool append:               %6.2fus\n' % append)
+    out.write('spool pop:                  %6.2fus\n' % pop)
+
+
+def _work(seconds):
+    """Run a CPU bound loop for seconds and return how many rounds it did.
+    """
+    rounds = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        sum(range(100))
+        rounds += 1
+    return rounds
+
+
+def bench_profiler(out, seconds=1.0):
+    """Slowdown of a CPU bound thread while StatsdProfiler samples it, at
+    the default and at a 1ms interval. Runs are interleaved and the best
+    of REPEAT kept, to keep machine noise out of the comparison.
+    """
+    import statsd
+    from statsd_profiler import StatsdProfiler
+    client = statsd.NullStatsdClient()
+    intervals = (None, 0.01, 0.001)
+    best = dict((interval, 0) for interval in intervals)
+    overhead = dict((interval, 0.0) for interval in intervals)
+    _work(seconds)  # warm up
+    for _ in range(REPEAT):
+        for interval in intervals:
+            if interval is None:
+                best[None] = max(best[None], _work(seconds))
+                continue
+            profiler = StatsdProfiler(client, interval=interval, flush_interval=1)
+            profiler.start()
+            try:
+                best[interval] = max(best[interval], _work(seconds))
+            finally:
+                profiler.stop()
+            overhead[interval] = max(overhead[interval], profiler.overhead)
+    baseline = best[None]
+    out.write('no profiler:                %d rounds\n' % baseline)
+    for interval in intervals[1:]:
+        out.write('interval %-5s              %d rounds, %.2f%% slower, '
+                  'sampling %.2f%% of wall time\n'
+                  % (interval, best[interval],
+                     100.0 * (baseline - best[interval]) / baseline,
+                     100 * overhead[interval]))
+
+
+BENCHMARKS = {'null': bench_null, 'spool': bench_spool, 'profiler': bench_profiler}
+
+
+def main(argv=None, out=sys.stdout):
+    names = (argv if argv is not None else sys.argv[1:]) or sorted(BENCHMARKS)
+    for name in names:
+        out.write('== %s\n' % name)
+        BENCHMARKS[name](out)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,17 @@
 # This file is part of python-statsd-client released under the Apache
 # License, Version 2.0. See the NOTICE for more information.
 
+import gevent
 from gevent.pool import Pool
 from gevent.socket import socket
 from socket import AF_INET, SOCK_DGRAM
-from statsd import _statsd, StatsdClient
+from statsd import _statsd, StatsdClient, NullStatsdClient, StatsdSpool
+from statsd import StatsdCardinalityGuard, _flush_periodically
 from statsd import StatsdCounter as StatsdCounterBase
 from statsd import StatsdTimer as StatsdTimerBase
 
 import logging
+import weakref
 
 _logger = logging.Logger(__name__)
 
@@ -19,25 +22,48 @@
 STATSD_SAMPLE_RATE = None
 STATSD_BUCKET_PREFIX = None
 STATSD_GREEN_POOL_SIZE = 50
+STATSD_ENABLED = True
+STATSD_SPOOL_PATH = None
+STATSD_SPOOL_SIZE = 1024 * 1024
+STATSD_SPOOL_REPLAY_RATE = 1000
+STATSD_SPOOL_REPLAY_BATCH = 50
+STATSD_DESTINATIONS = None
+STATSD_MAX_PACKET_SIZE = None
+STATSD_FLUSH_INTERVAL = 1.0
+STATSD_CARDINALITY_LIMIT = None
+STATSD_CARDINALITY_OVERFLOW_BUCKET = None
+STATSD_CARDINALITY_REJECTED_BUCKET = None
+STATSD_CARDINALITY_REPORT_INTERVAL = 10
+STATSD_SET_DEDUP_WINDOW = None
+STATSD_SET_DEDUP_SIZE = 10000
+STATSD_TAGS = None
+STATSD_TAG_CACHE_SIZE = 1000
 
 
-def decrement(bucket, delta=1, sample_rate=None):
-    _statsd.decr(bucket, delta, sample_rate)
+def decrement(bucket, delta=1, sample_rate=None, tags=None):
+    _statsd.decr(bucket, delta, sample_rate, tags)
 
-def increment(bucket, delta=1, sample_rate=None):
-    _statsd.incr(bucket, delta, sample_rate)
+def increment(bucket, delta=1, sample_rate=None, tags=None):
+    _statsd.incr(bucket, delta, sample_rate, tags)
 
-def gauge(bucket, value, sample_rate=None):
-    _statsd.gauge(bucket, value, sample_rate)
+def gauge(bucket, value, sample_rate=None, tags=None):
+    _statsd.gauge(bucket, value, sample_rate, tags)
 
-def timing(bucket, ms, sample_rate=None):
-    _statsd.timing(bucket, ms, sample_rate)
+def timing(bucket, ms, sample_rate=None, tags=None):
+    _statsd.timing(bucket, ms, sample_rate, tags)
+
+def set_value(bucket, value, sample_rate=None, tags=None):
+    _statsd.set(bucket, value, sample_rate, tags)
 
 class GEventStatsdClient(StatsdClient):
     """ GEvent Enabled statsd client
     """
     def __init__(self, pool_size=None,
-                 host=None, port=None, prefix=None, sample_rate=None):
+                 host=None, port=None, prefix=None, sample_rate=None,
+                 spool=None, destinations=None, max_packet_size=None,
+                 flush_interval=None, cardinality_guard=None,
+                 set_dedup_window=None, set_dedup_size=None,
+                 constant_tags=None, tag_cache_size=None):
         """
         Create GEvent enabled statsd client
         :param pool_size: Option size of the greenlet pool
@@ -45,35 +71,99 @@ def __init__(self, pool_size=None,
         :param port: port for the statsd server
         :param prefix: user defined prefix
         :param sample_rate: rate to which stats are dropped
+        :param spool: optional StatsdSpool for stats that can't be sent
+        :param destinations: list of statsd servers to shard buckets across
+        :param max_packet_size: batch stats into packets of up to this size
+        :param flush_interval: max seconds a stat stays in a batch
+        :param cardinality_guard: optional StatsdCardinalityGuard
+        :param set_dedup_window: seconds during which repeated set values aren't resent
+        :param set_dedup_size: max set values remembered per window
+        :param constant_tags: tags added to every stat
+        :param tag_cache_size: max encoded tag sets cached
         """
-        super(GEventStatsdClient, self).__init__(host, port, prefix, sample_rate)
+        super(GEventStatsdClient, self).__init__(host, port, prefix, sample_rate,
+                                                 spool, destinations, max_packet_size,
+                                                 flush_interval, cardinality_guard,
+                                                 set_dedup_window, set_dedup_size,
+                                                 constant_tags, tag_cache_size)
         self._send_pool = Pool(pool_size or STATSD_GREEN_POOL_SIZE)
+        self._sendto_ok = False
         self._socket = socket(AF_INET, SOCK_DGRAM)
 
-    def _socket_send(self, stat):
+    def _start_flusher(self):
+        """
+        Flush the buffers every flush_interval seconds from a greenlet.
+        """
+        gevent.spawn(_flush_periodically, weakref.ref(self), self._flush_interval,
+                     gevent.sleep)
+
+    def _flush_at_exit(self):
+        """
+        Flush the buffers and wait for the scheduled writes to finish.
+        """
+        self.flush()
+        self._send_pool.join(timeout=1)
+
+    def _socket_send(self, stat, addr):
         """
         Override the subclasses send method to schedule a udp write.
         :param stat: Stat string to write
+        :param addr: (host, port) to write it to
         """
-        # if we exceed the pool we drop the stat on the floor
+        # if we exceed the pool we spool the stat or drop it on the floor
         if not self._send_pool.full():
             # We can't monkey patch this as we don't want to ever block the calling greenlet
-            self._send_pool.spawn(self._socket.sendto, stat, (self._host, self._port))
+            self._send_pool.spawn(self._sendto, stat, addr)
+        elif self._spool is not None:
+            self._spool.append(stat)
+
+    def _sendto(self, stat, addr):
+        """
+        Write stat from a pool greenlet, spooling it if the write fails.
+        """
+        try:
+            self._socket.sendto(stat, addr)
+        except Exception:
+            self._sendto_ok = False
+            if self._spool is None:
+                raise
+            self._spool.append(stat)
+        else:
+            self._sendto_ok = True
+
+    def _spool_send(self, stat, addr):
+        """
+        Schedule stat and replay spooled stats into the free pool slots.
+        Sends fail in their greenlet, so failed stats are spooled there,
+        and replay waits until a greenlet's send has succeeded again.
+        """
+        self._socket_send(stat, addr)
+        if not self._sendto_ok:
+            return
+        free = self._send_pool.free_count()
+        if free and self._spool.used:
+            self._spool.replay(self._replay_send, limit=free)
 
 class StatsdCounter(StatsdCounterBase):
     """GEvent version of the Counter for StatsD.
     """
-    def __init__(self, bucket, statsd_client=None):
-        super(StatsdCounter, self).__init__(bucket)
-        self._client = statsd_client or GEventStatsdClient()
+    def __init__(self, bucket, statsd_client=None, tags=None):
+        super(StatsdCounter, self).__init__(bucket, tags=tags)
+        self._client = statsd_client or _default_client()
 
 
 class StatsdTimer(StatsdTimerBase):
     """GEvent version of the Timer for StatsD.
     """
-    def __init__(self, bucket, statsd_client=None):
-        super(StatsdTimer, self).__init__(bucket)
-        self._client = statsd_client or GEventStatsdClient()
+    def __init__(self, bucket, statsd_client=None, deferred=False, tags=None):
+        super(StatsdTimer, self).__init__(bucket, deferred=deferred, tags=tags)
+        self._client = statsd_client or _default_client()
+
+
+def _default_client():
+    if STATSD_ENABLED:
+        return GEventStatsdClient()
+    return NullStatsdClient()
 
 
 def monkey_patch_statsd():
@@ -92,6 +182,22 @@ def init_statsd(settings=None):
     global STATSD_PORT
     global STATSD_SAMPLE_RATE
     global STATSD_BUCKET_PREFIX
+    global STATSD_ENABLED
+    global STATSD_SPOOL_PATH
+    global STATSD_SPOOL_SIZE
+    global STATSD_SPOOL_REPLAY_RATE
+    global STATSD_SPOOL_REPLAY_BATCH
+    global STATSD_DESTINATIONS
+    global STATSD_MAX_PACKET_SIZE
+    global STATSD_FLUSH_INTERVAL
+    global STATSD_CARDINALITY_LIMIT
+    global STATSD_CARDINALITY_OVERFLOW_BUCKET
+    global STATSD_CARDINALITY_REJECTED_BUCKET
+    global STATSD_CARDINALITY_REPORT_INTERVAL
+    global STATSD_SET_DEDUP_WINDOW
+    global STATSD_SET_DEDUP_SIZE
+    global STATSD_TAGS
+    global STATSD_TAG_CACHE_SIZE
 
     if settings:
         STATSD_HOST = settings.get('STATSD_HOST', STATSD_HOST)
@@ -102,8 +208,58 @@ def init_statsd(settings=None):
                                             STATSD_BUCKET_PREFIX)
         STATSD_GREEN_POOL_SIZE = settings.get('STATSD_GREEN_POOL_SIZE',
                                               STATSD_GREEN_POOL_SIZE)
-    _statsd = GEventStatsdClient(host=STATSD_HOST, port=STATSD_PORT,
-                                 sample_rate=STATSD_SAMPLE_RATE, prefix=STATSD_BUCKET_PREFIX)
+        STATSD_ENABLED = settings.get('STATSD_ENABLED', STATSD_ENABLED)
+        STATSD_SPOOL_PATH = settings.get('STATSD_SPOOL_PATH', STATSD_SPOOL_PATH)
+        STATSD_SPOOL_SIZE = settings.get('STATSD_SPOOL_SIZE', STATSD_SPOOL_SIZE)
+        STATSD_SPOOL_REPLAY_RATE = settings.get('STATSD_SPOOL_REPLAY_RATE',
+                                                STATSD_SPOOL_REPLAY_RATE)
+        STATSD_SPOOL_REPLAY_BATCH = settings.get('STATSD_SPOOL_REPLAY_BATCH',
+                                                 STATSD_SPOOL_REPLAY_BATCH)
+        STATSD_DESTINATIONS = settings.get('STATSD_DESTINATIONS', STATSD_DESTINATIONS)
+        STATSD_MAX_PACKET_SIZE = settings.get('STATSD_MAX_PACKET_SIZE',
+                                              STATSD_MAX_PACKET_SIZE)
+        STATSD_FLUSH_INTERVAL = settings.get('STATSD_FLUSH_INTERVAL',
+                                             STATSD_FLUSH_INTERVAL)
+        STATSD_CARDINALITY_LIMIT = settings.get('STATSD_CARDINALITY_LIMIT',
+                                                STATSD_CARDINALITY_LIMIT)
+        STATSD_CARDINALITY_OVERFLOW_BUCKET = settings.get(
+            'STATSD_CARDINALITY_OVERFLOW_BUCKET', STATSD_CARDINALITY_OVERFLOW_BUCKET)
+        STATSD_CARDINALITY_REJECTED_BUCKET = settings.get(
+            'STATSD_CARDINALITY_REJECTED_BUCKET', STATSD_CARDINALITY_REJECTED_BUCKET)
+        STATSD_CARDINALITY_REPORT_INTERVAL = settings.get(
+            'STATSD_CARDINALITY_REPORT_INTERVAL', STATSD_CARDINALITY_REPORT_INTERVAL)
+        STATSD_SET_DEDUP_WINDOW = settings.get('STATSD_SET_DEDUP_WINDOW',
+                                               STATSD_SET_DEDUP_WINDOW)
+        STATSD_SET_DEDUP_SIZE = settings.get('STATSD_SET_DEDUP_SIZE',
+                                             STATSD_SET_DEDUP_SIZE)
+        STATSD_TAGS = settings.get('STATSD_TAGS', STATSD_TAGS)
+        STATSD_TAG_CACHE_SIZE = settings.get('STATSD_TAG_CACHE_SIZE',
+                                             STATSD_TAG_CACHE_SIZE)
+    if STATSD_ENABLED:
+        spool = None
+        if STATSD_SPOOL_PATH:
+            spool = StatsdSpool(STATSD_SPOOL_PATH, size=STATSD_SPOOL_SIZE,
+                                replay_rate=STATSD_SPOOL_REPLAY_RATE,
+                                replay_batch=STATSD_SPOOL_REPLAY_BATCH)
+        guard = None
+        if STATSD_CARDINALITY_LIMIT:
+            guard = StatsdCardinalityGuard(STATSD_CARDINALITY_LIMIT,
+                                           STATSD_CARDINALITY_OVERFLOW_BUCKET,
+                                           STATSD_CARDINALITY_REJECTED_BUCKET,
+                                           STATSD_CARDINALITY_REPORT_INTERVAL)
+        _statsd = GEventStatsdClient(host=STATSD_HOST, port=STATSD_PORT,
+                                     sample_rate=STATSD_SAMPLE_RATE, prefix=STATSD_BUCKET_PREFIX,
+                                     spool=spool, destinations=STATSD_DESTINATIONS,
+                                     max_packet_size=STATSD_MAX_PACKET_SIZE,
+                                     flush_interval=STATSD_FLUSH_INTERVAL,
+                                     cardinality_guard=guard,
+                                     set_dedup_window=STATSD_SET_DEDUP_WINDOW,
+                                     set_dedup_size=STATSD_SET_DEDUP_SIZE,
+                                     constant_tags=STATSD_TAGS,
+                                     tag_cache_size=STATSD_TAG_CACHE_SIZE)
+    else:
+        _statsd = NullStatsdClient(host=STATSD_HOST, port=STATSD_PORT,
+                                   sample_rate=STATSD_SAMPLE_RATE, prefix=STATSD_BUCKET_PREFIX)
     monkey_patch_statsd()
     return _statsd
 
@@ -3,8 +3,13 @@
 # This file is part of python-statsd-client released under the Apache
 # License, Version 2.0. See the NOTICE for more information.
 
+import os
+import shutil
+import socket
+import tempfile
 import unittest
 import time
+import gevent
 from gevent.pool import Pool as gevent_pool
 import gevent_statsd
 import statsd
@@ -27,6 +32,7 @@ def tearDown(self):
         gevent_statsd.STATSD_SAMPLE_RATE = None
         gevent_statsd.STATSD_BUCKET_PREFIX = None
         gevent_statsd.STATSD_GREEN_POOL_SIZE = 0
+        gevent_statsd.STATSD_ENABLED = True
 
     def test_init_statsd(self):
         self.assertEqual(gevent_statsd.STATSD_HOST, '127.0.0.1')
@@ -35,6 +41,13 @@ def test_init_statsd(self):
         self.assertEqual(gevent_statsd.STATSD_BUCKET_PREFIX, 'testing')
         self.assertEqual(gevent_statsd.STATSD_GREEN_POOL_SIZE, 50)
 
+    def test_init_statsd_disabled(self):
+        gevent_statsd.init_statsd({'STATSD_ENABLED': False})
+        self.assertTrue(isinstance(gevent_statsd._statsd, statsd.NullStatsdClient))
+        self.assertTrue(statsd._statsd is gevent_statsd._statsd)
+        self.assertTrue(isinstance(gevent_statsd.StatsdTimer('timeit')._client,
+                                   statsd.NullStatsdClient))
+
     def test_send_pool_is_full(self):
         mock_gevent_pool = mock(gevent_pool)
         when(mock_gevent_pool).full().thenReturn(False)
@@ -89,6 +102,40 @@ def test_timing(self):
         verify(mock_gevent_pool).spawn(any(), b'testing.timed:250|ms|@0.98', ('127.0.0.1', 9999))
 
 
+class TestGEventStatsdSpool(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._spool = statsd.StatsdSpool(os.path.join(self._dir, 'spool'),
+                                         size=1024, replay_rate=1000)
+        self._client = gevent_statsd.GEventStatsdClient(prefix='', spool=self._spool)
+        self._sent = []
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _sendto_raise_error(self, data, addr):
+        raise socket.error
+
+    def _sendto(self, data, addr):
+        self._sent.append(data)
+
+    def test_replay_after_successful_send(self):
+        self._client._socket.sendto = self._sendto_raise_error
+        for i in range(3):
+            self._client.incr('buck', i)
+            gevent.sleep(0)
+        self.assertEqual(self._spool.pop(), b'buck:0|c')
+        self._client._socket.sendto = self._sendto
+        self._spool._replayed_at -= 1
+        self._client.incr('buck', 3)
+        gevent.sleep(0)
+        self.assertEqual(self._sent, [b'buck:3|c'])
+        self._client.incr('buck', 4)
+        self._client._send_pool.join()
+        self.assertEqual(self._sent, [b'buck:3|c', b'buck:4|c', b'buck:1|c', b'buck:2|c'])
+
+
 class TestStatsdClient(unittest.TestCase):
 
     def test_prefix(self):
@@ -22,7 +22,7 @@ def main():
           author='Gaelen Hadlett',
           author_email='gaelenh@gmail.com',
           url='https://github.com/gaelenh/python-statsd-client',
-          py_modules=['statsd', 'gevent_statsd'],
+          py_modules=['statsd', 'gevent_statsd', 'statsd_profiler', 'statsd_loadgen'],
           keywords=['statsd', 'graphite', 'stats', 'gevent'],
           classifiers=['License :: OSI Approved :: Apache Software License',
                        'Programming Language :: Python :: 2.6',
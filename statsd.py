@@ -4,10 +4,21 @@
 # License, Version 2.0. See the NOTICE for more information.
 
 from __future__ import absolute_import
+import atexit
+import bisect
+import fcntl
 from functools import wraps
+from hashlib import md5
+import math
+import mmap
+import os
 import random
+import re
 from socket import socket, AF_INET, SOCK_DGRAM
+import struct
+import threading
 import time
+import weakref
 import logging
 
 __version__ = '1.0.4'
@@ -16,23 +27,120 @@
 STATSD_PORT = 8125
 STATSD_SAMPLE_RATE = None
 STATSD_BUCKET_PREFIX = None
+STATSD_ENABLED = True
+STATSD_SPOOL_PATH = None
+STATSD_SPOOL_SIZE = 1024 * 1024
+STATSD_SPOOL_REPLAY_RATE = 1000
+STATSD_SPOOL_REPLAY_BATCH = 50
+STATSD_DESTINATIONS = None
+STATSD_MAX_PACKET_SIZE = None
+STATSD_FLUSH_INTERVAL = 1.0
+STATSD_CARDINALITY_LIMIT = None
+STATSD_CARDINALITY_OVERFLOW_BUCKET = None
+STATSD_CARDINALITY_REJECTED_BUCKET = None
+STATSD_CARDINALITY_REPORT_INTERVAL = 10
+STATSD_SET_DEDUP_WINDOW = None
+STATSD_SET_DEDUP_SIZE = 10000
+STATSD_TAGS = None
+STATSD_TAG_CACHE_SIZE = 1000
 
-def decrement(bucket, delta=1, sample_rate=None):
-    _statsd.decr(bucket, delta, sample_rate)
+def decrement(bucket, delta=1, sample_rate=None, tags=None):
+    _statsd.decr(bucket, delta, sample_rate, tags)
 
-def increment(bucket, delta=1, sample_rate=None):
-    _statsd.incr(bucket, delta, sample_rate)
+def increment(bucket, delta=1, sample_rate=None, tags=None):
+    _statsd.incr(bucket, delta, sample_rate, tags)
 
-def gauge(bucket, value, sample_rate=None):
-    _statsd.gauge(bucket, value, sample_rate)
+def gauge(bucket, value, sample_rate=None, tags=None):
+    _statsd.gauge(bucket, value, sample_rate, tags)
 
-def timing(bucket, ms, sample_rate=None):
-    _statsd.timing(bucket, ms, sample_rate)
+def timing(bucket, ms, sample_rate=None, tags=None):
+    _statsd.timing(bucket, ms, sample_rate, tags)
+
+def set_value(bucket, value, sample_rate=None, tags=None):
+    _statsd.set(bucket, value, sample_rate, tags)
+
+
+_INVALID_TAG_CHARS = re.compile(r'[,|#\s]')
+_STRING_TYPES = (bytes, type(u''))
+
+def _normalize_tags(tags):
+    """Return tags, given as a dict, a single 'name:value' string, or a
+    list of 'name:value' strings or (name, value) pairs, as a dict of name
+    to value, or None for tags without a value.
+    """
+    if not tags:
+        return {}
+    if isinstance(tags, dict):
+        return dict(tags)
+    if isinstance(tags, _STRING_TYPES):
+        tags = [tags]
+    normalized = {}
+    for tag in tags:
+        if isinstance(tag, (tuple, list)):
+            name, value = tag
+        elif ':' in tag:
+            name, value = tag.split(':', 1)
+        else:
+            name, value = tag, None
+        normalized[name] = value
+    return normalized
+
+def _encode_tags(tags):
+    """Encode a dict of normalized tags as a sorted `|#name:value,...`
+    suffix.
+    """
+    if not tags:
+        return b''
+    encoded = []
+    for name, value in sorted(tags.items()):
+        tag = _INVALID_TAG_CHARS.sub(u'_', _tag_text(name))
+        if value is not None:
+            tag += u':' + _INVALID_TAG_CHARS.sub(u'_', _tag_text(value))
+        encoded.append(tag)
+    return b'|#' + u','.join(encoded).encode('utf8')
+
+def _tag_text(value):
+    """Return a tag name or value as text, decoding byte strings as UTF-8.
+    """
+    if isinstance(value, bytes):
+        return value.decode('utf8', 'replace')
+    return u'%s' % value
+
+# Largest UDP payload that fits a 1500 byte Ethernet frame without IP
+# fragmentation, leaving room for IP options.
+_MTU_PACKET_SIZE = 1432
+
+def _pack(stats, size):
+    """Yield stats joined into packets of up to size bytes. A stat longer
+    than size is sent in a packet of its own.
+    """
+    packet, length = [], 0
+    for stat in stats:
+        if packet and length + len(stat) > size:
+            yield b'\n'.join(packet)
+            packet, length = [], 0
+        packet.append(stat)
+        length += len(stat) + 1
+    if packet:
+        yield b'\n'.join(packet)
+
+def _tags_key(tags):
+    """Return a hashable key for tags holding unhashable items, such as
+    [name, value] lists.
+    """
+    return tuple(sorted(('%s' % name, None if value is None else '%s' % value)
+                        for name, value in _normalize_tags(tags).items()))
 
 
 class StatsdClient(object):
 
-    def __init__(self, host=None, port=None, prefix=None, sample_rate=None):
+    enabled = True
+
+    def __init__(self, host=None, port=None, prefix=None, sample_rate=None,
+                 spool=None, destinations=None, max_packet_size=None,
+                 flush_interval=None, cardinality_guard=None,
+                 set_dedup_window=None, set_dedup_size=None,
+                 constant_tags=None, tag_cache_size=None):
         self._host = host or STATSD_HOST
         self._port = port or STATSD_PORT
         self._sample_rate = sample_rate or STATSD_SAMPLE_RATE
@@ -40,84 +148,803 @@ def __init__(self, host=None, port=None, prefix=None, sample_rate=None):
         self._prefix = prefix or STATSD_BUCKET_PREFIX
         if self._prefix and not isinstance(self._prefix, bytes):
             self._prefix = self._prefix.encode('utf8')
+        self._spool = spool
+        self._guard = cardinality_guard
 
-    def timer(self, bucket):
-        return StatsdTimer(bucket, statsd_client=self)
+        self._ring = None
+        self._destinations = destinations or STATSD_DESTINATIONS
+        if self._destinations:
+            self._ring = StatsdHashRing(self._destinations)
 
-    def counter(self, bucket):
-        return StatsdCounter(bucket, statsd_client=self)
+        self._buffers = None
+        self._max_packet_size = max_packet_size or STATSD_MAX_PACKET_SIZE
+        self._flush_interval = flush_interval or STATSD_FLUSH_INTERVAL
+        if self._max_packet_size:
+            self._buffers = {}
+            self._buffer_sizes = {}
+            self._flush_at = time.time() + self._flush_interval
+            self._lock = threading.Lock()
+            _batching_clients.add(self)
+            self._start_flusher()
 
-    def decr(self, bucket, delta=1, sample_rate=None):
+        self._set_window = set_dedup_window or STATSD_SET_DEDUP_WINDOW
+        self._set_size = set_dedup_size or STATSD_SET_DEDUP_SIZE
+        self._set_values = {}
+        self._set_count = 0
+        self._set_window_end = 0
+
+        self._tag_cache = {}
+        self._tag_cache_old = {}
+        self._tag_cache_size = tag_cache_size or STATSD_TAG_CACHE_SIZE
+        self._tag_cache_generation = max(self._tag_cache_size // 2, 1)
+        self._constant_tags = _normalize_tags(constant_tags or STATSD_TAGS)
+        self._constant_suffix = _encode_tags(self._constant_tags)
+
+    def set_destinations(self, destinations):
+        """Replace the servers stats are sent to. Buffered stats are sent
+        first, and only buckets hashed to added or removed servers move.
+        """
+        self.flush()
+        self._destinations = destinations
+        self._ring = StatsdHashRing(destinations) if destinations else None
+
+    def _settings(self):
+        """Return the keyword arguments for a new client configured like
+        this one.
+        """
+        return dict(host=self._host, port=self._port, prefix=self._prefix,
+                    sample_rate=self._sample_rate, spool=self._spool,
+                    destinations=self._destinations,
+                    max_packet_size=self._max_packet_size,
+                    flush_interval=self._flush_interval,
+                    cardinality_guard=self._guard,
+                    set_dedup_window=self._set_window,
+                    set_dedup_size=self._set_size,
+                    constant_tags=self._constant_tags,
+                    tag_cache_size=self._tag_cache_size)
+
+    def flush(self):
+        """Send all buffered stats.
+        """
+        if self._guard is not None:
+            self._report_rejected()
+        if self._buffers is None:
+            return
+        with self._lock:
+            packets = [(b'\n'.join(stats), addr)
+                       for addr, stats in self._buffers.items() if stats]
+            self._buffers.clear()
+            self._buffer_sizes.clear()
+            self._flush_at = time.time() + self._flush_interval
+        for packet, addr in packets:
+            try:
+                self._deliver(packet, addr)
+            except Exception,e:
+                _logger.error("Failed to send statsd packet.", exc_info=True)
+
+    def _start_flusher(self):
+        """Flush the buffers every flush_interval seconds from a daemon
+        thread, so stats are sent even when no more stats follow them.
+        """
+        thread = threading.Thread(target=_flush_periodically,
+                                  args=(weakref.ref(self), self._flush_interval,
+                                        time.sleep))
+        thread.daemon = True
+        thread.start()
+
+    def _flush_at_exit(self):
+        self.flush()
+
+    def timer(self, bucket, deferred=False, tags=None):
+        return StatsdTimer(bucket, statsd_client=self, deferred=deferred, tags=tags)
+
+    def counter(self, bucket, tags=None):
+        return StatsdCounter(bucket, statsd_client=self, tags=tags)
+
+    def decr(self, bucket, delta=1, sample_rate=None, tags=None):
         """Decrements a counter by delta.
         """
         value = str(-1 * delta).encode('utf8') + b'|c'
-        self._send(bucket, value, sample_rate)
+        self._send(bucket, value, sample_rate, tags)
 
-    def incr(self, bucket, delta=1, sample_rate=None):
+    def incr(self, bucket, delta=1, sample_rate=None, tags=None):
         """Increment a counter by delta.
         """
         value = str(delta).encode('utf8') + b'|c'
-        self._send(bucket, value, sample_rate)
+        self._send(bucket, value, sample_rate, tags)
 
-    def gauge(self, bucket, value, sample_rate=None):
+    def gauge(self, bucket, value, sample_rate=None, tags=None):
         """Send a gauge value.
         """
         str_value = str(value).encode('utf8') + b'|g'
-        self._send(bucket, str_value, sample_rate)
+        self._send(bucket, str_value, sample_rate, tags)
+
+    def set(self, bucket, value, sample_rate=None, tags=None):
+        """Add value to a set, counting the unique values.
+        """
+        str_value = str(value).encode('utf8')
+        if not self._set_window:
+            self._send(bucket, str_value + b'|s', sample_rate, tags)
+            return
+        try:
+            key = (bucket, self._tag_suffix(tags)) if tags else bucket
+            if self._set_seen(key, str_value):
+                return
+            stat = self._format(bucket, str_value + b'|s', sample_rate, tags)
+            if stat is None:
+                return
+            self._send_stat(stat)
+            self._set_remember(key, str_value)
+        except Exception,e:
+            _logger.error("Failed to send statsd packet.", exc_info=True)
+
+    def _tag_suffix(self, tags):
+        """Return the encoded `|#name:value,...` suffix for tags plus the
+        constant tags, so a repeated tag set costs a dict lookup.
+
+        Suffixes are cached in two generations of up to half of
+        tag_cache_size each. When the current one is full it becomes the
+        old one, and suffixes found in the old one move back to the current
+        one, so the least recently used tag sets are the ones dropped.
+        """
+        if not tags:
+            return self._constant_suffix
+        try:
+            if isinstance(tags, dict):
+                key = frozenset(tags.items())
+            elif isinstance(tags, list):
+                key = tuple(tags)
+            else:
+                key = tags
+            hash(key)
+        except TypeError:
+            key = _tags_key(tags)
+        cache = self._tag_cache
+        suffix = cache.get(key)
+        if suffix is None:
+            suffix = self._tag_cache_old.get(key)
+            if suffix is None:
+                merged = self._constant_tags.copy()
+                merged.update(_normalize_tags(tags))
+                suffix = _encode_tags(merged)
+            if len(cache) >= self._tag_cache_generation:
+                self._tag_cache_old = cache
+                cache = self._tag_cache = {}
+            cache[key] = suffix
+        return suffix
+
+    def _set_seen(self, bucket, value):
+        """Return True if value was already sent to the set bucket in the
+        current de-duplication window.
+        """
+        now = time.time()
+        if now >= self._set_window_end:
+            self._set_values = {}
+            self._set_count = 0
+            self._set_window_end = now + self._set_window
+        values = self._set_values.get(bucket)
+        return values is not None and value in values
+
+    def _set_remember(self, bucket, value):
+        """Remember a value sent to the set bucket. Each value and each
+        bucket counts towards the set_dedup_size entries kept per window,
+        so buckets can't grow the state past it either.
+        """
+        values = self._set_values.get(bucket)
+        size = 1 if values is not None else 2
+        if self._set_count + size > self._set_size:
+            return
+        if values is None:
+            values = self._set_values[bucket] = set()
+        values.add(value)
+        self._set_count += size
+
+    def _socket_send(self, stat, addr):
+        self._socket.sendto(stat, addr)
+
+    def _route(self, stat):
+        """Return the address of the server for stat's bucket.
+        """
+        if self._ring is None:
+            return (self._host, self._port)
+        return self._ring.get_node(stat[:stat.index(b':')])
+
+    def _replay_send(self, stat):
+        self._socket_send(stat, self._route(stat))
 
-    def _socket_send(self, stat):
-        self._socket.sendto(stat, (self._host, self._port))
+    def _spool_send(self, stat, addr):
+        """Send stat, keeping it in the spool if the send fails and
+        replaying spooled stats once sends succeed again.
+        """
+        try:
+            self._socket_send(stat, addr)
+        except Exception:
+            self._spool.append(stat)
+            raise
+        if self._spool.used:
+            self._spool.replay(self._replay_send)
+
+    def _deliver(self, packet, addr):
+        if self._spool is None:
+            self._socket_send(packet, addr)
+        else:
+            self._spool_send(packet, addr)
+
+    def _buffer(self, stat, addr):
+        """Add stat to the send buffer of addr. A buffer is sent as a
+        single packet once the next stat would not fit in it, and all
+        buffers are sent every flush_interval seconds by the flusher.
+        A late flush is also done here, for forked processes that don't
+        inherit the flusher thread.
+        """
+        packet = None
+        with self._lock:
+            stats = self._buffers.get(addr)
+            if stats is None:
+                stats = self._buffers[addr] = []
+                self._buffer_sizes[addr] = 0
+            size = self._buffer_sizes[addr]
+            if stats and size + len(stat) > self._max_packet_size:
+                packet = b'\n'.join(stats)
+                del stats[:]
+                size = 0
+            stats.append(stat)
+            self._buffer_sizes[addr] = size + len(stat) + 1
+        if packet is not None:
+            self._deliver(packet, addr)
+        if time.time() >= self._flush_at:
+            self.flush()
 
-    def _send(self, bucket, value, sample_rate=None):
+    def _format(self, bucket, value, sample_rate=None, tags=None):
+        """Format a stat, or return None if it is sampled out or
+        rejected by the cardinality guard.
+        """
+        bucket = bucket if isinstance(bucket, bytes) else bucket.encode('utf8')
+        if self._guard is not None:
+            admitted = self._guard.admit(bucket)
+            if admitted is not bucket:
+                self._report_rejected()
+                if admitted is None:
+                    return None
+                bucket = admitted
+
+        sample_rate = sample_rate or self._sample_rate
+        if sample_rate and sample_rate < 1.0 and sample_rate > 0:
+            if random.random() <= sample_rate:
+                value = value + b'|@' + str(sample_rate).encode('utf8')
+            else:
+                return None
+
+        if tags or self._constant_suffix:
+            value = value + self._tag_suffix(tags)
+        if self._prefix:
+            bucket = self._prefix + b'.' + bucket
+        return bucket + b':' + value
+
+    def _report_rejected(self):
+        """Send the number of stats the cardinality guard rejected since
+        its last report, if one is due.
+        """
+        count = self._guard.take_report()
+        if not count:
+            return
+        bucket = self._guard.rejected_bucket
+        if self._prefix:
+            bucket = self._prefix + b'.' + bucket
+        stat = bucket + b':' + str(count).encode('utf8') + b'|c' + self._constant_suffix
+        try:
+            self._send_stat(stat)
+        except Exception,e:
+            _logger.error("Failed to send statsd packet.", exc_info=True)
+
+    def _send(self, bucket, value, sample_rate=None, tags=None):
         """Format and send data to statsd.
         """
         try:
-           bucket = bucket if isinstance(bucket, bytes) else bucket.encode('utf8')
+           stat = self._format(bucket, value, sample_rate, tags)
+           if stat is not None:
+               self._send_stat(stat)
+        except Exception,e:
+            _logger.error("Failed to send statsd packet.", exc_info=True)
 
-           sample_rate = sample_rate or self._sample_rate
-           if sample_rate and sample_rate < 1.0 and sample_rate > 0:
-               if random.random() <= sample_rate:
-                   value = value + b'|@' + str(sample_rate).encode('utf8')
-               else:
-                   return
+    def _send_stat(self, stat):
+        """Buffer or deliver a formatted stat to its server.
+        """
+        addr = self._route(stat)
+        if self._buffers is not None:
+            self._buffer(stat, addr)
+        else:
+            self._deliver(stat, addr)
 
-           stat = bucket + b':' + value
-           if self._prefix:
-               stat = self._prefix + b'.' + stat
+    def _send_many(self, stats, sample_rate=None, tags=None):
+        """Format (bucket, value) pairs and send them together, in as few
+        packets per server as fit in max_packet_size, or in a typical
+        Ethernet MTU without batching.
+        """
+        try:
+           packets = {}
+           for bucket, value in stats:
+               stat = self._format(bucket, value, sample_rate, tags)
+               if stat is not None:
+                   packets.setdefault(self._route(stat), []).append(stat)
 
-           self._socket_send(stat)
+           for addr, lines in packets.items():
+               if self._buffers is not None:
+                   for stat in lines:
+                       self._buffer(stat, addr)
+               else:
+                   for packet in _pack(lines, _MTU_PACKET_SIZE):
+                       self._deliver(packet, addr)
         except Exception,e:
             _logger.error("Failed to send statsd packet.", exc_info=True)
 
-    def timing(self, bucket, ms, sample_rate=None):
+    def timing(self, bucket, ms, sample_rate=None, tags=None):
         """Creates a timing sample.
         """
         value = str(ms).encode('utf8') + b'|ms'
-        self._send(bucket, value, sample_rate)
+        self._send(bucket, value, sample_rate, tags)
+
+
+_batching_clients = weakref.WeakSet()
+
+def _flush_periodically(client_ref, interval, sleep):
+    """Flush the client every interval seconds until it is garbage
+    collected.
+    """
+    while True:
+        sleep(interval)
+        client = client_ref()
+        if client is None:
+            return
+        try:
+            client.flush()
+        except Exception,e:
+            _logger.error("Failed to flush statsd buffers.", exc_info=True)
+        del client
+
+@atexit.register
+def _flush_all():
+    """Send the stats still buffered by any client at interpreter exit.
+    """
+    for client in list(_batching_clients):
+        try:
+            client._flush_at_exit()
+        except Exception,e:
+            _logger.error("Failed to flush statsd buffers.", exc_info=True)
+
+
+class NullStatsdClient(StatsdClient):
+    """Client that drops every stat without formatting or sending it.
+    """
+
+    enabled = False
+
+    def __init__(self, host=None, port=None, prefix=None, sample_rate=None,
+                 spool=None, destinations=None, max_packet_size=None,
+                 flush_interval=None, cardinality_guard=None,
+                 set_dedup_window=None, set_dedup_size=None,
+                 constant_tags=None, tag_cache_size=None):
+        # Keep the configuration StatsdClient keeps, so _settings() and the
+        # other helpers work, but open no socket and start no flusher.
+        self._host = host or STATSD_HOST
+        self._port = port or STATSD_PORT
+        self._sample_rate = sample_rate or STATSD_SAMPLE_RATE
+        self._socket = None
+        self._prefix = prefix or STATSD_BUCKET_PREFIX
+        if self._prefix and not isinstance(self._prefix, bytes):
+            self._prefix = self._prefix.encode('utf8')
+        self._spool = spool
+        self._guard = cardinality_guard
+        self._ring = None
+        self._destinations = destinations or STATSD_DESTINATIONS
+        self._buffers = None
+        self._max_packet_size = max_packet_size or STATSD_MAX_PACKET_SIZE
+        self._flush_interval = flush_interval or STATSD_FLUSH_INTERVAL
+        self._set_window = set_dedup_window or STATSD_SET_DEDUP_WINDOW
+        self._set_size = set_dedup_size or STATSD_SET_DEDUP_SIZE
+        self._set_values = {}
+        self._set_count = 0
+        self._set_window_end = 0
+        self._tag_cache = {}
+        self._tag_cache_old = {}
+        self._tag_cache_size = tag_cache_size or STATSD_TAG_CACHE_SIZE
+        self._tag_cache_generation = max(self._tag_cache_size // 2, 1)
+        self._constant_tags = _normalize_tags(constant_tags or STATSD_TAGS)
+        self._constant_suffix = _encode_tags(self._constant_tags)
+
+    def set_destinations(self, destinations):
+        pass
+
+    def flush(self):
+        pass
+
+    def decr(self, bucket, delta=1, sample_rate=None, tags=None):
+        pass
+
+    def incr(self, bucket, delta=1, sample_rate=None, tags=None):
+        pass
+
+    def gauge(self, bucket, value, sample_rate=None, tags=None):
+        pass
+
+    def timing(self, bucket, ms, sample_rate=None, tags=None):
+        pass
+
+    def set(self, bucket, value, sample_rate=None, tags=None):
+        pass
+
+    def _socket_send(self, stat, addr):
+        pass
+
+    def _send(self, bucket, value, sample_rate=None, tags=None):
+        pass
+
+    def _send_many(self, stats, sample_rate=None, tags=None):
+        pass
+
+
+class StatsdHashRing(object):
+    """Consistent hash ring mapping bucket names to statsd servers.
+
+    Each server is hashed onto the ring at several points, and a bucket is
+    sent to the server owning the first point at or after the bucket's
+    hash. Adding or removing a server only moves the buckets that hash
+    next to its points.
+    """
+
+    def __init__(self, destinations, replicas=100):
+        """
+        :param destinations: (host, port) tuples or 'host:port' strings
+        :param replicas: points on the ring per server
+        """
+        points = []
+        for destination in destinations:
+            if isinstance(destination, (tuple, list)):
+                host, port = destination
+            elif ':' in destination:
+                host, port = destination.rsplit(':', 1)
+            else:
+                host, port = destination, STATSD_PORT
+            addr = (host, int(port))
+            for replica in range(replicas):
+                key = ('%s:%d-%d' % (host, addr[1], replica)).encode('utf8')
+                points.append((self._hash(key), addr))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+
+    @staticmethod
+    def _hash(key):
+        return struct.unpack_from('>I', md5(key).digest())[0]
+
+    def get_node(self, key):
+        """Return the (host, port) of the server for key.
+        """
+        index = bisect.bisect(self._hashes, self._hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._nodes[index]
+
+
+class StatsdCardinalityGuard(object):
+    """Caps the number of distinct buckets a client sends to.
+
+    The first `limit` buckets seen are kept in an allowlist and pass
+    through. Stats for any other bucket are dropped, or renamed to
+    overflow_bucket if one is given, and counted in `rejected`. With a
+    rejected_bucket, clients also send the count as a counter at most
+    every report_interval seconds. The total number of distinct buckets
+    seen is tracked in constant memory with a HyperLogLog sketch, see
+    estimate().
+    """
+
+    _PRECISION = 10
+
+    def __init__(self, limit=None, overflow_bucket=None, rejected_bucket=None,
+                 report_interval=None):
+        """
+        :param limit: max number of distinct buckets let through
+        :param overflow_bucket: bucket to send rejected stats to instead
+        :param rejected_bucket: counter bucket the number of rejected stats is sent to
+        :param report_interval: min seconds between sends of the rejected count
+        """
+        self._limit = limit or STATSD_CARDINALITY_LIMIT
+        self._overflow = overflow_bucket or STATSD_CARDINALITY_OVERFLOW_BUCKET
+        if self._overflow and not isinstance(self._overflow, bytes):
+            self._overflow = self._overflow.encode('utf8')
+        self.rejected_bucket = rejected_bucket or STATSD_CARDINALITY_REJECTED_BUCKET
+        if self.rejected_bucket and not isinstance(self.rejected_bucket, bytes):
+            self.rejected_bucket = self.rejected_bucket.encode('utf8')
+        self._report_interval = report_interval or STATSD_CARDINALITY_REPORT_INTERVAL
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget every bucket seen and zero the counters.
+        """
+        self._allowed = set()
+        self._registers = bytearray(1 << self._PRECISION)
+        self.rejected = 0
+        self._reported = 0
+        self._report_at = 0
+
+    def admit(self, bucket):
+        """Return the bucket to send a stat for bucket to, or None to
+        drop it.
+        """
+        if bucket in self._allowed:
+            return bucket
+        with self._lock:
+            self._count(bucket)
+            if bucket in self._allowed:
+                return bucket
+            if len(self._allowed) < self._limit:
+                self._allowed.add(bucket)
+                return bucket
+            self.rejected += 1
+        return self._overflow or None
+
+    def take_report(self):
+        """Return the number of stats rejected since the last report, or 0
+        if there is no rejected_bucket or the last report was less than
+        report_interval seconds ago.
+        """
+        if not self.rejected_bucket:
+            return 0
+        with self._lock:
+            now = time.time()
+            if now < self._report_at or self.rejected == self._reported:
+                return 0
+            count = self.rejected - self._reported
+            self._reported = self.rejected
+            self._report_at = now + self._report_interval
+            return count
+
+    def _count(self, bucket):
+        value = struct.unpack_from('<Q', md5(bucket).digest())[0]
+        index = value & ((1 << self._PRECISION) - 1)
+        value >>= self._PRECISION
+        if value:
+            rank = (value & -value).bit_length()
+        else:
+            rank = 64 - self._PRECISION + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+    def estimate(self):
+        """Estimated number of distinct buckets seen, allowed or not.
+        """
+        registers = self._registers
+        size = len(registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0 ** -rank for rank in registers)
+        zeros = registers.count(b'\x00')
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / float(zeros))
+        return int(round(estimate))
+
+
+class StatsdSpool(object):
+    """Fixed size ring buffer of stats backed by a memory-mapped file.
+
+    Stats are appended as length prefixed records. When the buffer is full
+    the oldest records are overwritten. The read and write offsets live in
+    the file header, so a restarted process picks up where the previous one
+    left off.
+
+    Records are written to the mapping only, never with write() or fsync().
+    Appends and replay batches do take an flock, plus a getpid() to notice
+    forks, so several processes, including forked children, can share a
+    spool file as long as they all use the same size. Stats are only
+    appended after their sendto failed, and replay pops a whole batch
+    under one lock, so locking adds a few syscalls per failed send and
+    per replay batch rather than per stat sent.
+    """
+
+    _MAGIC = b'SSPL'
+    _HEADER = struct.Struct('<4sIIII')
+    _LENGTH = struct.Struct('<H')
+    _USED = struct.Struct('<I')
+    _USED_OFFSET = 16
+    _WRAP = 0xffff
+
+    def __init__(self, path, size=None, replay_rate=None, replay_batch=None):
+        """
+        :param path: file backing the spool, created if missing
+        :param size: capacity in bytes of the ring buffer
+        :param replay_rate: max stats replayed per second
+        :param replay_batch: max stats replayed per call of replay()
+        """
+        self._path = path
+        self._capacity = size or STATSD_SPOOL_SIZE
+        self._replay_rate = replay_rate or STATSD_SPOOL_REPLAY_RATE
+        self._replay_batch = replay_batch or STATSD_SPOOL_REPLAY_BATCH
+        self._replayed_at = time.time()
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+        length = self._HEADER.size + self._capacity
+        self._pid = os.getpid()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size != length:
+                os.ftruncate(self._fd, length)
+            self._map = mmap.mmap(self._fd, length)
+            magic, capacity, self._head, self._tail, self._used = \
+                self._HEADER.unpack_from(self._map, 0)
+            if magic != self._MAGIC or capacity != self._capacity:
+                self._head = self._tail = self._used = 0
+                self._write_header()
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @property
+    def used(self):
+        """Bytes of the ring buffer in use, as seen by all processes.
+        """
+        return self._USED.unpack_from(self._map, self._USED_OFFSET)[0]
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _acquire(self):
+        """Lock the spool against other threads and processes, and load
+        the offsets they may have changed.
+        """
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                # flock locks are shared with the parent through inherited
+                # descriptors, so a forked child needs its own.
+                self._fd = os.open(self._path, os.O_RDWR)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except Exception:
+            self._lock.release()
+            raise
+        _, _, self._head, self._tail, self._used = \
+            self._HEADER.unpack_from(self._map, 0)
+
+    def _release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def _write_header(self):
+        self._HEADER.pack_into(self._map, 0, self._MAGIC, self._capacity,
+                               self._head, self._tail, self._used)
+
+    def _skip_wrap(self):
+        """Move head back to the start if it sits on the unused tail end
+        of the buffer.
+        """
+        remaining = self._capacity - self._head
+        if remaining < self._LENGTH.size or self._LENGTH.unpack_from(
+                self._map, self._HEADER.size + self._head)[0] == self._WRAP:
+            self._used -= remaining
+            self._head = 0
+
+    def _pop(self):
+        self._skip_wrap()
+        offset = self._HEADER.size + self._head
+        length = self._LENGTH.unpack_from(self._map, offset)[0]
+        start = offset + self._LENGTH.size
+        stat = self._map[start:start + length]
+        self._head += self._LENGTH.size + length
+        self._used -= self._LENGTH.size + length
+        if not self._used:
+            self._head = self._tail = 0
+        return stat
+
+    def append(self, stat):
+        """Add stat to the spool, dropping the oldest stats if needed.
+        """
+        size = self._LENGTH.size + len(stat)
+        if size > self._capacity or len(stat) >= self._WRAP:
+            self.dropped += 1
+            return
+        self._acquire()
+        try:
+            while True:
+                remaining = self._capacity - self._tail
+                wasted = remaining if remaining < size else 0
+                if self._capacity - self._used >= wasted + size:
+                    break
+                self._pop()
+                self.dropped += 1
+
+            if remaining < size:
+                if remaining >= self._LENGTH.size:
+                    self._LENGTH.pack_into(self._map,
+                                           self._HEADER.size + self._tail,
+                                           self._WRAP)
+                self._used += remaining
+                self._tail = 0
+            offset = self._HEADER.size + self._tail
+            self._LENGTH.pack_into(self._map, offset, len(stat))
+            start = offset + self._LENGTH.size
+            self._map[start:start + len(stat)] = stat
+            self._tail += size
+            self._used += size
+            self._write_header()
+        finally:
+            self._release()
+
+    def pop(self):
+        """Remove and return the oldest stat, or None if empty.
+        """
+        self._acquire()
+        try:
+            if not self._used:
+                return None
+            stat = self._pop()
+            self._write_header()
+            return stat
+        finally:
+            self._release()
+
+    def replay(self, send, limit=None):
+        """Call send with spooled stats, at most replay_rate per second,
+        replay_batch per call and limit this call. If a send fails, that
+        stat and the rest of the batch are put back and replay stops.
+        """
+        now = time.time()
+        available = min((now - self._replayed_at) * self._replay_rate,
+                        float(self._replay_rate))
+        budget = min(int(available), self._replay_batch)
+        if limit is not None:
+            budget = min(budget, limit)
+        if budget <= 0:
+            return
+        # Unused rate budget carries over to the next call.
+        self._replayed_at = now - (available - budget) / self._replay_rate
+        stats = []
+        self._acquire()
+        try:
+            while self._used and len(stats) < budget:
+                stats.append(self._pop())
+            if stats:
+                self._write_header()
+        finally:
+            self._release()
+        for index, stat in enumerate(stats):
+            try:
+                send(stat)
+            except Exception:
+                for unsent in stats[index:]:
+                    self.append(unsent)
+                raise
 
 
 class StatsdCounter(object):
     """Counter for StatsD.
     """
-    def __init__(self, bucket, statsd_client=None):
+    def __init__(self, bucket, statsd_client=None, tags=None):
         self._client = statsd_client or _statsd
         self._bucket = bucket if isinstance(bucket, bytes) else bucket.encode('utf8')
+        self._tags = tags
 
     def __add__(self, num):
-        self._client.incr(self._bucket, delta=num)
+        self._client.incr(self._bucket, delta=num, tags=self._tags)
         return self
 
     def __sub__(self, num):
-        self._client.decr(self._bucket, delta=num)
+        self._client.decr(self._bucket, delta=num, tags=self._tags)
         return self
 
 
 class StatsdTimer(object):
     """Timer for StatsD.
+
+    A deferred timer doesn't send anything until stop(), which then sends
+    the splits and the total together in a single packet.
     """
-    def __init__(self, bucket, statsd_client=None):
+    def __init__(self, bucket, statsd_client=None, deferred=False, tags=None):
         self._client = statsd_client or _statsd
         self._bucket = bucket if isinstance(bucket, bytes) else bucket.encode('utf8')
+        self._deferred = deferred
+        self._tags = tags
 
     def __enter__(self):
         self.start()
@@ -132,26 +959,45 @@ def __exit__(self, type, value, traceback):
     def start(self, bucket_key=b'start'):
         """Start the timer.
         """
+        if not self._client.enabled:
+            return
         bucket_key = bucket_key if isinstance(bucket_key, bytes) else bucket_key.encode('utf8')
         self._start = time.time() * 1000
         self._splits = [(bucket_key, self._start), ]
 
     def split(self, bucket_key):
         """Records time since start() or last call to split() and sends
-        result to statsd.
+        result to statsd, or keeps it for stop() if the timer is deferred.
         """
+        if not self._client.enabled:
+            return
         bucket_key = bucket_key if isinstance(bucket_key, bytes) else bucket_key.encode('utf8')
         self._splits.append((bucket_key, time.time() * 1000))
+        if self._deferred:
+            return
         self._client.timing(self._bucket + b'.' + bucket_key,
-                            self._splits[-1][1] - self._splits[-2][1])
+                            self._splits[-1][1] - self._splits[-2][1],
+                            tags=self._tags)
 
     def stop(self, bucket_key=b'total'):
         """Stops the timer and sends total time to statsd.
         """
+        if not self._client.enabled:
+            return
         bucket_key = bucket_key if isinstance(bucket_key, bytes) else bucket_key.encode('utf8')
         self._stop = time.time() * 1000
-        self._client.timing(self._bucket + b'.' + bucket_key,
-                            self._stop - self._start)
+        if not self._deferred:
+            self._client.timing(self._bucket + b'.' + bucket_key,
+                                self._stop - self._start, tags=self._tags)
+            return
+
+        stats = []
+        for (_, split_start), (split_key, split_stop) in zip(self._splits, self._splits[1:]):
+            stats.append((self._bucket + b'.' + split_key,
+                          str(split_stop - split_start).encode('utf8') + b'|ms'))
+        stats.append((self._bucket + b'.' + bucket_key,
+                      str(self._stop - self._start).encode('utf8') + b'|ms'))
+        self._client._send_many(stats, tags=self._tags)
 
     def __call__(self, func):
         @wraps(func)
@@ -169,6 +1015,22 @@ def init_statsd(settings=None):
     global STATSD_PORT
     global STATSD_SAMPLE_RATE
     global STATSD_BUCKET_PREFIX
+    global STATSD_ENABLED
+    global STATSD_SPOOL_PATH
+    global STATSD_SPOOL_SIZE
+    global STATSD_SPOOL_REPLAY_RATE
+    global STATSD_SPOOL_REPLAY_BATCH
+    global STATSD_DESTINATIONS
+    global STATSD_MAX_PACKET_SIZE
+    global STATSD_FLUSH_INTERVAL
+    global STATSD_CARDINALITY_LIMIT
+    global STATSD_CARDINALITY_OVERFLOW_BUCKET
+    global STATSD_CARDINALITY_REJECTED_BUCKET
+    global STATSD_CARDINALITY_REPORT_INTERVAL
+    global STATSD_SET_DEDUP_WINDOW
+    global STATSD_SET_DEDUP_SIZE
+    global STATSD_TAGS
+    global STATSD_TAG_CACHE_SIZE
 
     if settings:
         STATSD_HOST = settings.get('STATSD_HOST', STATSD_HOST)
@@ -177,10 +1039,56 @@ def init_statsd(settings=None):
                                           STATSD_SAMPLE_RATE)
         STATSD_BUCKET_PREFIX = settings.get('STATSD_BUCKET_PREFIX',
                                             STATSD_BUCKET_PREFIX)
+        STATSD_ENABLED = settings.get('STATSD_ENABLED', STATSD_ENABLED)
+        STATSD_SPOOL_PATH = settings.get('STATSD_SPOOL_PATH', STATSD_SPOOL_PATH)
+        STATSD_SPOOL_SIZE = settings.get('STATSD_SPOOL_SIZE', STATSD_SPOOL_SIZE)
+        STATSD_SPOOL_REPLAY_RATE = settings.get('STATSD_SPOOL_REPLAY_RATE',
+                                                STATSD_SPOOL_REPLAY_RATE)
+        STATSD_SPOOL_REPLAY_BATCH = settings.get('STATSD_SPOOL_REPLAY_BATCH',
+                                                 STATSD_SPOOL_REPLAY_BATCH)
+        STATSD_DESTINATIONS = settings.get('STATSD_DESTINATIONS', STATSD_DESTINATIONS)
+        STATSD_MAX_PACKET_SIZE = settings.get('STATSD_MAX_PACKET_SIZE',
+                                              STATSD_MAX_PACKET_SIZE)
+        STATSD_FLUSH_INTERVAL = settings.get('STATSD_FLUSH_INTERVAL',
+                                             STATSD_FLUSH_INTERVAL)
+        STATSD_CARDINALITY_LIMIT = settings.get('STATSD_CARDINALITY_LIMIT',
+                                                STATSD_CARDINALITY_LIMIT)
+        STATSD_CARDINALITY_OVERFLOW_BUCKET = settings.get(
+            'STATSD_CARDINALITY_OVERFLOW_BUCKET', STATSD_CARDINALITY_OVERFLOW_BUCKET)
+        STATSD_CARDINALITY_REJECTED_BUCKET = settings.get(
+            'STATSD_CARDINALITY_REJECTED_BUCKET', STATSD_CARDINALITY_REJECTED_BUCKET)
+        STATSD_CARDINALITY_REPORT_INTERVAL = settings.get(
+            'STATSD_CARDINALITY_REPORT_INTERVAL', STATSD_CARDINALITY_REPORT_INTERVAL)
+        STATSD_SET_DEDUP_WINDOW = settings.get('STATSD_SET_DEDUP_WINDOW',
+                                               STATSD_SET_DEDUP_WINDOW)
+        STATSD_SET_DEDUP_SIZE = settings.get('STATSD_SET_DEDUP_SIZE',
+                                             STATSD_SET_DEDUP_SIZE)
+        STATSD_TAGS = settings.get('STATSD_TAGS', STATSD_TAGS)
+        STATSD_TAG_CACHE_SIZE = settings.get('STATSD_TAG_CACHE_SIZE',
+                                             STATSD_TAG_CACHE_SIZE)
 
-
-    _statsd = StatsdClient(host=STATSD_HOST, port=STATSD_PORT,
-                           sample_rate=STATSD_SAMPLE_RATE, prefix=STATSD_BUCKET_PREFIX)
+    spool = None
+    if STATSD_ENABLED and STATSD_SPOOL_PATH:
+        spool = StatsdSpool(STATSD_SPOOL_PATH, size=STATSD_SPOOL_SIZE,
+                            replay_rate=STATSD_SPOOL_REPLAY_RATE,
+                            replay_batch=STATSD_SPOOL_REPLAY_BATCH)
+    guard = None
+    if STATSD_ENABLED and STATSD_CARDINALITY_LIMIT:
+        guard = StatsdCardinalityGuard(STATSD_CARDINALITY_LIMIT,
+                                       STATSD_CARDINALITY_OVERFLOW_BUCKET,
+                                       STATSD_CARDINALITY_REJECTED_BUCKET,
+                                       STATSD_CARDINALITY_REPORT_INTERVAL)
+    client_class = StatsdClient if STATSD_ENABLED else NullStatsdClient
+    _statsd = client_class(host=STATSD_HOST, port=STATSD_PORT,
+                           sample_rate=STATSD_SAMPLE_RATE, prefix=STATSD_BUCKET_PREFIX,
+                           spool=spool, destinations=STATSD_DESTINATIONS,
+                           max_packet_size=STATSD_MAX_PACKET_SIZE,
+                           flush_interval=STATSD_FLUSH_INTERVAL,
+                           cardinality_guard=guard,
+                           set_dedup_window=STATSD_SET_DEDUP_WINDOW,
+                           set_dedup_size=STATSD_SET_DEDUP_SIZE,
+                           constant_tags=STATSD_TAGS,
+                           tag_cache_size=STATSD_TAG_CACHE_SIZE)
     return _statsd
 
 _logger = logging.getLogger('statsd')
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of python-statsd-client released under the Apache
+# License, Version 2.0. See the NOTICE for more information.
+
+"""Synthetic statsd load generator.
+
+Sends a mix of counters, gauges, timers and sets at a target rate from
+several processes and threads (or greenlets), then reports the achieved
+rate, client CPU time per metric and send errors:
+
+    python -m statsd_loadgen --sink --processes 4 --threads 8 --rate 50000
+
+With --sink stats are sent to a local UDP socket that counts what it
+receives, so no statsd server is needed.
+"""
+
+from __future__ import absolute_import
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import statsd
+
+MIX = 'counter=6,gauge=2,timer=2'
+KINDS = ('counter', 'gauge', 'timer', 'set')
+
+
+class LoadStatsdClient(statsd.StatsdClient):
+    """StatsdClient that counts failed sends instead of logging them.
+    """
+
+    def __init__(self, *args, **kw):
+        super(LoadStatsdClient, self).__init__(*args, **kw)
+        self.errors = 0
+        self._errors_lock = threading.Lock()
+
+    def _socket_send(self, stat, addr):
+        try:
+            self._socket.sendto(stat, addr)
+        except Exception:
+            with self._errors_lock:
+                self.errors += 1
+
+
+def _gevent_client_class():
+    from gevent_statsd import GEventStatsdClient
+
+    class LoadGEventStatsdClient(GEventStatsdClient):
+        """GEventStatsdClient that counts failed sends, and sends dropped
+        because the send pool was full.
+        """
+
+        def __init__(self, *args, **kw):
+            super(LoadGEventStatsdClient, self).__init__(*args, **kw)
+            self.errors = 0
+            self.dropped = 0
+
+        def _sendto(self, stat, addr):
+            try:
+                self._socket.sendto(stat, addr)
+            except Exception:
+                self.errors += 1
+
+        def _socket_send(self, stat, addr):
+            if self._send_pool.full():
+                self.dropped += 1
+            else:
+                self._send_pool.spawn(self._sendto, stat, addr)
+
+    return LoadGEventStatsdClient
+
+
+def parse_mix(mix):
+    """Parse 'counter=6,gauge=2,...' into a list of (kind, cumulative
+    probability).
+    """
+    weights = []
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in KINDS:
+            raise ValueError('Unknown metric type %r in mix' % kind)
+        weight = float(weight or 1)
+        if weight < 0:
+            raise ValueError('Negative weight for %r in mix' % kind)
+        weights.append((kind, weight))
+    total = sum(weight for _, weight in weights)
+    if total <= 0:
+        raise ValueError('Metric mix %r has no weight' % mix)
+    mix, cumulative = [], 0.0
+    for kind, weight in weights:
+        cumulative += weight / total
+        mix.append((kind, cumulative))
+    return mix
+
+
+class UdpSink(object):
+    """Local UDP server counting the packets and stats it receives.
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, 0))
+        self._socket.settimeout(0.1)
+        self.address = self._socket.getsockname()
+        self.packets = 0
+        self.stats = 0
+        self._running = True
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            try:
+                packet = self._socket.recv(65536)
+            except socket.timeout:
+                continue
+            self.packets += 1
+            self.stats += packet.count(b'\n') + 1
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        self._socket.close()
+
+
+def _generate(client, options, mix, rate, sleep, chunk=1000, ready=None):
+    """Send metrics at rate per second for options.duration seconds and
+    return how many were sent. Metrics are sent chunk at a time, calling
+    ready(count) before each chunk of count metrics and sleep(0) after it.
+    """
+    buckets = dict((kind, ['%s.%d' % (kind, i) for i in range(options.cardinality)])
+                   for kind in KINDS)
+    sample_rate = options.sample_rate
+    sent = 0
+    started = time.time()
+    while True:
+        elapsed = time.time() - started
+        if elapsed >= options.duration:
+            return sent
+        due = int(elapsed * rate) - sent
+        if due <= 0:
+            sleep(0.001)
+            continue
+        due = min(due, chunk)
+        if ready is not None:
+            ready(due)
+        for _ in range(due):
+            choice = random.random()
+            for kind, cumulative in mix:
+                if choice <= cumulative:
+                    break
+            bucket = random.choice(buckets[kind])
+            if kind == 'counter':
+                client.incr(bucket, 1, sample_rate)
+            elif kind == 'gauge':
+                client.gauge(bucket, random.randint(0, 1000), sample_rate)
+            elif kind == 'timer':
+                client.timing(bucket, random.randint(0, 1000), sample_rate)
+            else:
+                client.set(bucket, random.randint(0, options.cardinality * 10), sample_rate)
+        sent += due
+        sleep(0)
+
+
+def run_process(options, addr):
+    """Run options.threads workers in this process and return a dict of
+    metrics sent, send errors and CPU seconds used.
+    """
+    mix = parse_mix(options.mix)
+    rate = float(options.rate) / (options.processes * options.threads)
+    kw = dict(host=addr[0], port=addr[1], prefix=options.prefix,
+              max_packet_size=options.max_packet_size)
+    cpu_started = sum(os.times()[:2])
+
+    if options.greenlets:
+        import gevent
+        import gevent_statsd
+        client = _gevent_client_class()(pool_size=options.pool_size, **kw)
+        # A finished send frees its pool slot only a loop iteration later,
+        # so yielding once isn't enough: wait until the pool has room for
+        # the whole chunk, or the client would drop what doesn't fit.
+        pool = client._send_pool
+        pool_size = options.pool_size or gevent_statsd.STATSD_GREEN_POOL_SIZE
+        chunk = max(pool_size // options.threads, 1)
+        def ready(count):
+            while pool.free_count() < count:
+                gevent.sleep(0)
+        workers = [gevent.spawn(_generate, client, options, mix, rate, gevent.sleep,
+                                chunk, ready)
+                   for _ in range(options.threads)]
+        gevent.joinall(workers, raise_error=True)
+        sent = sum(worker.value for worker in workers)
+        client.flush()
+        pool.join()
+        dropped = client.dropped
+    else:
+        client = LoadStatsdClient(**kw)
+        counts, failures = [], []
+        def worker():
+            try:
+                counts.append(_generate(client, options, mix, rate, time.sleep))
+            except Exception:
+                failures.append(traceback.format_exc())
+        workers = [threading.Thread(target=worker) for _ in range(options.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if failures:
+            raise RuntimeError('Load worker failed:\n%s' % failures[0])
+        sent = sum(counts)
+        client.flush()
+        dropped = 0
+
+    return {'sent': sent, 'errors': client.errors, 'dropped': dropped,
+            'cpu': sum(os.times()[:2]) - cpu_started}
+
+
+def _process_main(options, addr, results):
+    try:
+        results.put(run_process(options, addr))
+    except Exception:
+        # Always put a result, or run() would wait for it forever.
+        results.put({'error': traceback.format_exc()})
+
+
+def run(options):
+    """Run the load described by options and return a dict of totals.
+    """
+    sink = UdpSink() if options.sink else None
+    addr = sink.address if sink else (options.host, options.port)
+    started = time.time()
+    try:
+        # Workers always run in child processes so the CPU time they
+        # report doesn't include the sink's.
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=_process_main,
+                                             args=(options, addr, queue))
+                     for _ in range(options.processes)]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+        elapsed = time.time() - started
+        if sink:
+            time.sleep(0.2)
+    finally:
+        if sink:
+            sink.close()
+
+    for result in results:
+        if 'error' in result:
+            raise RuntimeError('Load process failed:\n%s' % result['error'])
+    totals = {'sent': sum(result['sent'] for result in results),
+              'errors': sum(result['errors'] for result in results),
+              'dropped': sum(result['dropped'] for result in results),
+              'cpu': sum(result['cpu'] for result in results),
+              'elapsed': elapsed}
+    if sink:
+        totals['received_packets'] = sink.packets
+        totals['received_stats'] = sink.stats
+    return totals
+
+
+def report(options, totals, out):
+    sent = totals['sent']
+    out.write('metrics sent:   %d\n' % sent)
+    out.write('achieved rate:  %.0f/s (target %d/s)\n'
+              % (sent / totals['elapsed'], options.rate))
+    if sent:
+        out.write('cpu per metric: %.1fus\n' % (totals['cpu'] * 1e6 / sent))
+    out.write('send errors:    %d\n' % totals['errors'])
+    if options.greenlets:
+        out.write('pool full:      %d\n' % totals['dropped'])
+    if 'received_stats' in totals:
+        out.write('sink received:  %d stats in %d packets\n'
+                  % (totals['received_stats'], totals['received_packets']))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m statsd_loadgen',
+                                     description='Generate synthetic statsd load.')
+    parser.add_argument('--host', default=statsd.STATSD_HOST)
+    parser.add_argument('--port', type=int, default=statsd.STATSD_PORT)
+    parser.add_argument('--sink', action='store_true',
+                        help='send to a local UDP sink instead of host:port')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=1,
+                        help='threads, or greenlets with --greenlets, per process')
+    parser.add_argument('--greenlets', action='store_true',
+                        help='use gevent_statsd with greenlets instead of threads')
+    parser.add_argument('--pool-size', type=int, default=None,
+                        help='gevent send pool size')
+    parser.add_argument('--rate', type=int, default=1000,
+                        help='target metrics per second, over all workers')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run')
+    parser.add_argument('--mix', default=MIX,
+                        help='weights of %s (default %s)' % ('/'.join(KINDS), MIX))
+    parser.add_argument('--cardinality', type=int, default=100,
+                        help='distinct buckets per metric type')
+    parser.add_argument('--sample-rate', type=float, default=None)
+    parser.add_argument('--prefix', default='loadgen')
+    parser.add_argument('--max-packet-size', type=int, default=None,
+                        help='batch stats into packets of up to this size')
+    options = parser.parse_args(argv)
+    try:
+        parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    return options
+
+
+def main(argv=None, out=sys.stdout):
+    options = parse_args(argv)
+    totals = run(options)
+    report(options, totals, out)
+    return totals
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of python-statsd-client released under the Apache
+# License, Version 2.0. See the NOTICE for more information.
+
+import socket
+import unittest
+import statsd
+import statsd_loadgen
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import gevent
+except ImportError:
+    gevent = None
+
+
+class TestStatsdLoadgen(unittest.TestCase):
+
+    def setUp(self):
+        statsd.socket = socket.socket
+
+    def test_parse_mix(self):
+        mix = statsd_loadgen.parse_mix('counter=3,gauge=1')
+        self.assertEqual(mix, [('counter', 0.75), ('gauge', 1.0)])
+        mix = statsd_loadgen.parse_mix('timer')
+        self.assertEqual(mix, [('timer', 1.0)])
+        self.assertRaises(ValueError, statsd_loadgen.parse_mix, 'histogram=1')
+        self.assertRaises(ValueError, statsd_loadgen.parse_mix, 'counter=0')
+        self.assertRaises(ValueError, statsd_loadgen.parse_mix, 'counter=-1,gauge=2')
+
+    def test_sink(self):
+        out = StringIO()
+        totals = statsd_loadgen.main(['--sink', '--processes', '2', '--threads', '2',
+                                      '--rate', '2000', '--duration', '0.5',
+                                      '--mix', 'counter=1,gauge=1,timer=1,set=1'], out)
+        self.assertTrue(totals['sent'] > 500)
+        self.assertEqual(totals['errors'], 0)
+        self.assertEqual(totals['received_stats'], totals['sent'])
+        self.assertEqual(totals['received_packets'], totals['sent'])
+        self.assertTrue('achieved rate:' in out.getvalue())
+        self.assertTrue('cpu per metric:' in out.getvalue())
+
+    def test_sink_batched(self):
+        totals = statsd_loadgen.main(['--sink', '--rate', '2000', '--duration', '0.5',
+                                      '--max-packet-size', '512'], StringIO())
+        self.assertEqual(totals['received_stats'], totals['sent'])
+        self.assertTrue(totals['received_packets'] < totals['sent'])
+
+    @unittest.skipIf(gevent is None, 'gevent is not installed')
+    def test_sink_greenlets(self):
+        out = StringIO()
+        totals = statsd_loadgen.main(['--sink', '--greenlets', '--threads', '4',
+                                      '--pool-size', '10', '--rate', '10000',
+                                      '--duration', '0.5'], out)
+        self.assertEqual(totals['errors'], 0)
+        self.assertEqual(totals['dropped'], 0)
+        self.assertEqual(totals['received_stats'], totals['sent'])
+        self.assertTrue('pool full:' in out.getvalue())
+
+    def test_process_error(self):
+        run_process = statsd_loadgen.run_process
+        def failing_run_process(options, addr):
+            raise ValueError('boom')
+        statsd_loadgen.run_process = failing_run_process
+        try:
+            self.assertRaises(RuntimeError, statsd_loadgen.main,
+                              ['--sink', '--duration', '0.1'], StringIO())
+        finally:
+            statsd_loadgen.run_process = run_process
+
+    def test_worker_error(self):
+        self.assertRaises(RuntimeError, statsd_loadgen.main,
+                          ['--sink', '--duration', '0.1', '--cardinality', '0'],
+                          StringIO())
+
+    def test_generate_yields_per_chunk(self):
+        class client(object):
+            def incr(self, bucket, delta, sample_rate):
+                pass
+        options = statsd_loadgen.parse_args(['--duration', '0.05', '--mix', 'counter'])
+        mix = statsd_loadgen.parse_mix(options.mix)
+        sleeps, chunks = [], []
+        sent = statsd_loadgen._generate(client(), options, mix, 100000, sleeps.append, 10,
+                                        chunks.append)
+        self.assertTrue(sent > 10)
+        self.assertTrue(sleeps.count(0) >= sent // 10)
+        self.assertEqual(sum(chunks), sent)
+        self.assertTrue(max(chunks) <= 10)
+
+if __name__ == '__main__':
+    unittest.main()
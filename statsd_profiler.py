@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of python-statsd-client released under the Apache
+# License, Version 2.0. See the NOTICE for more information.
+
+from __future__ import absolute_import
+import logging
+import os
+import re
+from socket import AF_INET, SOCK_DGRAM
+import sys
+import time
+
+import statsd
+
+try:
+    from gevent.monkey import get_original
+except ImportError:
+    get_original = None
+
+_logger = logging.getLogger('statsd')
+
+STATSD_PROFILER_INTERVAL = 0.01
+STATSD_PROFILER_FLUSH_INTERVAL = 10
+STATSD_PROFILER_PREFIX = 'profile'
+STATSD_PROFILER_MAX_OVERHEAD = 0.01
+STATSD_PROFILER_MAX_FUNCTIONS = 100
+STATSD_PROFILER_IDLE_FUNCTIONS = ()
+
+# Functions a thread or the gevent hub sits in while it waits. A sample
+# whose top frame is one of these is idle time, not work.
+_IDLE_FUNCTIONS = frozenset([
+    'statsd._flush_periodically',
+    'statsd_profiler._run',
+    'threading.wait',
+    'threading._wait_for_tstate_lock',
+    'hub.run',
+    'hub.sleep',
+    'hub.switch',
+    'hub.wait',
+    'hub.join',
+    '_hub_primitives.wait',
+    '_hub_primitives.wait_on_objects',
+    '_waiter.get',
+    '_waiter.switch',
+])
+
+_THREAD_MODULE = 'thread' if sys.version_info[0] == 2 else '_thread'
+_INVALID_CHARS = re.compile(r'[^A-Za-z0-9_\-]')
+
+
+def _original(module, name):
+    """Return module.name as it was before any gevent monkey patching, so
+    the sampler runs in a real thread even under gevent.
+    """
+    if get_original is not None:
+        return get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+def _module(code):
+    return os.path.splitext(os.path.basename(code.co_filename))[0]
+
+
+def _default_client():
+    client = statsd._statsd
+    gevent_statsd = sys.modules.get('gevent_statsd')
+    if gevent_statsd and isinstance(client, gevent_statsd.GEventStatsdClient):
+        # The gevent client spawns greenlets to send, which is only safe
+        # from the thread running the hub. Its replacement must not use
+        # anything gevent may have patched either: batching and the spool
+        # take locks, the guard too, and the socket waits on the hub.
+        settings = client._settings()
+        settings.update(max_packet_size=None, spool=None, cardinality_guard=None)
+        client = statsd.StatsdClient(**settings)
+        client._socket = _original('socket', 'socket')(AF_INET, SOCK_DGRAM)
+    return client
+
+
+class StatsdProfiler(object):
+    """Sampling profiler reporting hot functions to statsd.
+
+    A background thread periodically looks at the top frame of every other
+    thread with sys._current_frames() and counts samples per function.
+    Under gevent the running greenlet's stack is the stack of its thread,
+    so only the greenlet on the CPU is sampled, not the switched out ones.
+    Threads waiting in a known idle function, such as the gevent hub, a
+    lock wait or the client's flusher, are skipped. Every flush_interval
+    seconds the most sampled functions are sent as
+    `<prefix>.<module>.<function>` counters of samples and
+    `<prefix>.<module>.<function>.wall` timers of the estimated wall-clock
+    time spent in them. Time blocked in C calls such as time.sleep() or
+    socket reads still counts against the calling function.
+
+    The sampler sleeps longer between samples whenever needed to keep the
+    time it spends sampling under max_overhead of wall time.
+    """
+
+    def __init__(self, statsd_client=None, interval=None, flush_interval=None,
+                 prefix=None, max_overhead=None, max_functions=None,
+                 idle_functions=None):
+        """
+        :param statsd_client: client used, from the sampler thread, to send stats
+        :param interval: seconds between samples
+        :param flush_interval: seconds between sends of the sample counts
+        :param prefix: bucket prefix for profile stats
+        :param max_overhead: max fraction of wall time spent sampling
+        :param max_functions: max functions sent per flush, most sampled first
+        :param idle_functions: more '<module>.<function>' names of functions
+            where threads wait, whose samples are skipped
+        """
+        self._client = statsd_client or _default_client()
+        self._interval = interval or STATSD_PROFILER_INTERVAL
+        self._flush_interval = flush_interval or STATSD_PROFILER_FLUSH_INTERVAL
+        self._prefix = prefix or STATSD_PROFILER_PREFIX
+        self._max_overhead = max_overhead or STATSD_PROFILER_MAX_OVERHEAD
+        self._max_functions = max_functions or STATSD_PROFILER_MAX_FUNCTIONS
+        self._idle_functions = _IDLE_FUNCTIONS.union(
+            idle_functions or STATSD_PROFILER_IDLE_FUNCTIONS)
+        self._idle_codes = {}
+        self._counts = {}
+        self._samples = 0
+        self._sampling_time = 0.0
+        self._started_at = None
+        self._flushed_at = time.time()
+        self._get_ident = _original(_THREAD_MODULE, 'get_ident')
+        self._token = None
+
+    @property
+    def overhead(self):
+        """Fraction of wall time spent sampling since start().
+        """
+        if self._started_at is None:
+            return 0.0
+        return self._sampling_time / max(time.time() - self._started_at, 1e-9)
+
+    def start(self):
+        """Start sampling in a background thread.
+        """
+        if self._token is not None:
+            return
+        # Each run gets its own token, so a thread from a previous run
+        # still sleeping when start() is called again exits instead of
+        # sampling alongside the new one.
+        token = self._token = object()
+        self._started_at = self._flushed_at = time.time()
+        self._sampling_time = 0.0
+        _original(_THREAD_MODULE, 'start_new_thread')(self._run, (token,))
+
+    def stop(self):
+        """Stop sampling. Samples not flushed yet are dropped.
+        """
+        self._token = None
+
+    def _run(self, token):
+        sleep = _original('time', 'sleep')
+        flush_at = time.time() + self._flush_interval
+        while self._token is token:
+            started = time.time()
+            self.sample()
+            cost = time.time() - started
+            self._sampling_time += cost
+            if started >= flush_at:
+                try:
+                    self.flush()
+                except Exception:
+                    _logger.error("Failed to flush statsd profile.", exc_info=True)
+                flush_at = started + self._flush_interval
+            sleep(max(self._interval, cost / self._max_overhead))
+
+    def sample(self):
+        """Count the function on top of each thread's stack, except the
+        calling thread's own and idle ones.
+        """
+        counts = self._counts
+        idle_codes = self._idle_codes
+        own_ident = self._get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            code = frame.f_code
+            idle = idle_codes.get(code)
+            if idle is None:
+                idle = idle_codes[code] = self._is_idle(code)
+            if not idle:
+                counts[code] = counts.get(code, 0) + 1
+        self._samples += 1
+
+    def _is_idle(self, code):
+        return '%s.%s' % (_module(code), code.co_name) in self._idle_functions
+
+    def _bucket(self, code):
+        return '%s.%s.%s' % (self._prefix, _INVALID_CHARS.sub('_', _module(code)),
+                             _INVALID_CHARS.sub('_', code.co_name))
+
+    def flush(self):
+        """Send the sample counts gathered since the last flush.
+        """
+        now = time.time()
+        counts, self._counts = self._counts, {}
+        samples, self._samples = self._samples, 0
+        elapsed, self._flushed_at = now - self._flushed_at, now
+        if not samples:
+            return
+        sample_ms = elapsed * 1000.0 / samples
+        hottest = sorted(counts.items(), key=lambda item: item[1], reverse=True)
+        for code, count in hottest[:self._max_functions]:
+            bucket = self._bucket(code)
+            self._client.incr(bucket, count, sample_rate=1)
+            self._client.timing(bucket + '.wall', int(count * sample_ms), sample_rate=1)
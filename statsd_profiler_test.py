@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of python-statsd-client released under the Apache
+# License, Version 2.0. See the NOTICE for more information.
+
+import sys
+import threading
+import time
+import unittest
+import statsd
+import statsd_profiler
+
+
+class mock_statsd_client(object):
+    def __init__(self):
+        self.incrs = {}
+        self.timings = {}
+
+    def incr(self, bucket, delta=1, sample_rate=None):
+        self.incrs[bucket] = self.incrs.get(bucket, 0) + delta
+
+    def timing(self, bucket, ms, sample_rate=None):
+        self.timings[bucket] = self.timings.get(bucket, 0) + ms
+
+
+def sleepy_loop(state):
+    while not state['done']:
+        time.sleep(0.001)
+
+
+def busy_loop(state):
+    state['running'] = True
+    while not state['done']:
+        sum(range(100))
+
+
+class TestStatsdProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self._state = {'running': False, 'done': False}
+        self._thread = threading.Thread(target=busy_loop, args=(self._state,))
+        self._thread.start()
+        while not self._state['running']:
+            time.sleep(0.001)
+
+    def tearDown(self):
+        self._state['done'] = True
+        self._thread.join()
+
+    def test_default_client(self):
+        profiler = statsd_profiler.StatsdProfiler()
+        self.assertTrue(profiler._client is statsd._statsd)
+
+    def test_default_client_gevent(self):
+        class GEventStatsdClient(statsd.StatsdClient):
+            pass
+        gevent_statsd = type(sys)('gevent_statsd')
+        gevent_statsd.GEventStatsdClient = GEventStatsdClient
+        client = GEventStatsdClient(prefix='app', destinations=['127.0.0.1:9999'],
+                                    max_packet_size=512, constant_tags={'env': 'prod'},
+                                    cardinality_guard=statsd.StatsdCardinalityGuard(10))
+        default, modules = statsd._statsd, sys.modules.copy()
+        statsd._statsd = client
+        sys.modules['gevent_statsd'] = gevent_statsd
+        try:
+            profiler = statsd_profiler.StatsdProfiler()
+        finally:
+            statsd._statsd = default
+            sys.modules.clear()
+            sys.modules.update(modules)
+        self.assertTrue(type(profiler._client) is statsd.StatsdClient)
+        settings = client._settings()
+        settings.update(max_packet_size=None, spool=None, cardinality_guard=None)
+        self.assertEqual(profiler._client._settings(), settings)
+        self.assertEqual(profiler._client._buffers, None)
+
+    def test_sample_flush(self):
+        client = mock_statsd_client()
+        profiler = statsd_profiler.StatsdProfiler(client, prefix='prof')
+        for _ in range(20):
+            profiler.sample()
+            time.sleep(0.001)
+        profiler.flush()
+        self.assertEqual(client.incrs.get('prof.statsd_profiler_test.busy_loop'), 20)
+        self.assertTrue('prof.statsd_profiler_test.busy_loop.wall' in client.timings)
+        self.assertFalse('prof.statsd_profiler.sample' in client.incrs)
+
+        client.incrs.clear()
+        profiler.flush()
+        self.assertEqual(client.incrs, {})
+
+    def test_skip_idle(self):
+        event = threading.Event()
+        waiter = threading.Thread(target=event.wait)
+        waiter.start()
+        sleeper = threading.Thread(target=sleepy_loop, args=(self._state,))
+        sleeper.start()
+        statsd.StatsdClient(max_packet_size=512, flush_interval=60)
+        time.sleep(0.05)
+        client = mock_statsd_client()
+        profiler = statsd_profiler.StatsdProfiler(
+            client, prefix='prof', idle_functions=['statsd_profiler_test.sleepy_loop'])
+        try:
+            for _ in range(20):
+                profiler.sample()
+                time.sleep(0.001)
+        finally:
+            event.set()
+            self._state['done'] = True
+            waiter.join()
+            sleeper.join()
+        profiler.flush()
+        self.assertEqual(list(client.incrs), ['prof.statsd_profiler_test.busy_loop'])
+
+    def test_max_functions(self):
+        client = mock_statsd_client()
+        profiler = statsd_profiler.StatsdProfiler(client, prefix='prof', max_functions=1)
+        for _ in range(5):
+            profiler.sample()
+        profiler.flush()
+        self.assertEqual(len(client.incrs), 1)
+
+    def test_bucket_name(self):
+        profiler = statsd_profiler.StatsdProfiler(mock_statsd_client(), prefix='prof')
+        code = compile('pass', '/src/my.module.py', 'exec')
+        self.assertEqual(profiler._bucket(code), 'prof.my_module._module_')
+
+    def test_start_stop(self):
+        client = mock_statsd_client()
+        profiler = statsd_profiler.StatsdProfiler(client, interval=0.001,
+                                                  flush_interval=0.05, prefix='prof')
+        profiler.start()
+        time.sleep(0.3)
+        profiler.stop()
+        time.sleep(0.05)
+        self.assertTrue(client.incrs.get('prof.statsd_profiler_test.busy_loop', 0) > 0)
+        self.assertTrue(0 < profiler.overhead < 1)
+
+    def test_restart(self):
+        profiler = statsd_profiler.StatsdProfiler(mock_statsd_client(), interval=0.2)
+        profiler.start()
+        time.sleep(0.05)
+        profiler.stop()
+        profiler.start()
+        time.sleep(0.3)
+        samplers = 0
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                if frame.f_code is profiler._run.__func__.__code__ and \
+                        frame.f_locals.get('self') is profiler:
+                    samplers += 1
+                frame = frame.f_back
+        profiler.stop()
+        self.assertEqual(samplers, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,12 @@
 # This file is part of python-statsd-client released under the Apache
 # License, Version 2.0. See the NOTICE for more information.
 
+import os
+import shutil
+import tempfile
 import unittest
 import socket
+import threading
 import time
 import statsd
 
@@ -30,6 +34,17 @@ def tearDown(self):
         statsd.STATSD_PORT = 8125
         statsd.STATSD_SAMPLE_RATE = None
         statsd.STATSD_BUCKET_PREFIX = None
+        statsd.STATSD_ENABLED = True
+        statsd.STATSD_SPOOL_PATH = None
+        statsd.STATSD_DESTINATIONS = None
+        statsd.STATSD_MAX_PACKET_SIZE = None
+        statsd.STATSD_CARDINALITY_LIMIT = None
+        statsd.STATSD_CARDINALITY_OVERFLOW_BUCKET = None
+        statsd.STATSD_CARDINALITY_REJECTED_BUCKET = None
+        statsd.STATSD_CARDINALITY_REPORT_INTERVAL = 10
+        statsd.STATSD_SET_DEDUP_WINDOW = None
+        statsd.STATSD_TAGS = None
+        statsd.init_statsd()
 
     def test_init_statsd(self):
         settings = {'STATSD_HOST': '127.0.0.1',
@@ -42,6 +57,25 @@ def test_init_statsd(self):
         self.assertEqual(statsd.STATSD_SAMPLE_RATE, 0.99)
         self.assertEqual(statsd.STATSD_BUCKET_PREFIX, 'testing')
 
+    def test_init_statsd_disabled(self):
+        statsd.init_statsd({'STATSD_ENABLED': False})
+        self.assertFalse(statsd.STATSD_ENABLED)
+        self.assertTrue(isinstance(statsd._statsd, statsd.NullStatsdClient))
+        self.assertEqual(statsd._statsd._socket, None)
+        statsd.increment('counted')
+        statsd.decrement('counted')
+        statsd.gauge('gauged', 1)
+        statsd.timing('timed', 250)
+
+    def test_null_client_settings(self):
+        client = statsd.NullStatsdClient(prefix='app', destinations=['127.0.0.1:9999'],
+                                         constant_tags=['env:prod'])
+        settings = client._settings()
+        self.assertEqual(settings['prefix'], b'app')
+        self.assertEqual(settings['destinations'], ['127.0.0.1:9999'])
+        self.assertEqual(settings['constant_tags'], {'env': 'prod'})
+        self.assertEqual(client._tag_suffix(None), b'|#env:prod')
+
     def test_exception_in_send(self):
         def mock_sendto_raise_error(data, addr):
            mock_sendto_raise_error.exception_raised = True
@@ -80,6 +114,19 @@ def test_gauge(self):
         if statsd._statsd._socket.data != b'gauged:-5|g':
             self.assertTrue(statsd._statsd._socket.data.endswith(b'|@0.99'))
 
+    def test_set_value(self):
+        statsd.set_value('users', 'abc')
+        self.assertEqual(statsd._statsd._socket.data, b'users:abc|s')
+        statsd.set_value('users', 42)
+        self.assertEqual(statsd._statsd._socket.data, b'users:42|s')
+
+    def test_tags(self):
+        statsd.init_statsd({'STATSD_TAGS': {'env': 'prod'}})
+        statsd.increment('counted', tags=['region:x'])
+        self.assertEqual(statsd._statsd._socket.data, b'counted:1|c|#env:prod,region:x')
+        statsd.gauge('gauged', 1)
+        self.assertEqual(statsd._statsd._socket.data, b'gauged:1|g|#env:prod')
+
     def test_timing(self):
         statsd.timing('timed', 250)
         self.assertEqual(statsd._statsd._socket.data, b'timed:250|ms')
@@ -154,6 +201,75 @@ def test_timing_sample_rate(self):
         if client._socket.data != '':
             self.assertTrue(client._socket.data.endswith(b'|@0.999'))
 
+    def test_set(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        client.set('buck.set', 'user1')
+        self.assertEqual(client._socket.data, b'buck.set:user1|s')
+        client._socket.data = None
+        client.set('buck.set', 'user1')
+        self.assertEqual(client._socket.data, b'buck.set:user1|s')
+
+    def test_set_dedup(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60)
+        client.set('buck.set', 'user1')
+        self.assertEqual(client._socket.data, b'buck.set:user1|s')
+        client._socket.data = None
+        client.set('buck.set', 'user1')
+        self.assertEqual(client._socket.data, None)
+        client.set('other.set', 'user1')
+        self.assertEqual(client._socket.data, b'other.set:user1|s')
+        client._socket.data = None
+        client._set_window_end = 0
+        client.set('buck.set', 'user1')
+        self.assertEqual(client._socket.data, b'buck.set:user1|s')
+
+    def test_set_dedup_sampled_out(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60)
+        client._socket.data = None
+        random = statsd.random.random
+        statsd.random.random = lambda: 0.9
+        try:
+            client.set('buck.set', 'user1', sample_rate=0.5)
+            self.assertEqual(client._socket.data, None)
+        finally:
+            statsd.random.random = random
+        self.assertEqual(client._set_values, {})
+        client.set('buck.set', 'user1')
+        self.assertEqual(client._socket.data, b'buck.set:user1|s')
+
+    def test_set_dedup_rejected(self):
+        guard = statsd.StatsdCardinalityGuard(limit=1)
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60, cardinality_guard=guard)
+        client.set('buck.set', 'user1')
+        client._socket.data = None
+        client.set('other.set', 'user1')
+        self.assertEqual(client._socket.data, None)
+        self.assertFalse('other.set' in client._set_values)
+
+    def test_set_dedup_size(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60, set_dedup_size=2)
+        for value in ('a', 'b', 'c'):
+            client.set('buck.set', value)
+        self.assertEqual(client._set_count, 2)
+        client._socket.data = None
+        client.set('buck.set', 'c')
+        self.assertEqual(client._socket.data, b'buck.set:c|s')
+        client._socket.data = None
+        client.set('buck.set', 'a')
+        self.assertEqual(client._socket.data, None)
+
+    def test_set_dedup_size_bounds_buckets(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60, set_dedup_size=5)
+        for i in range(10):
+            client.set('buck%d.set' % i, 'user1')
+        self.assertEqual(len(client._set_values), 2)
+        self.assertTrue(client._set_count <= 5)
+
     def test_timer_factory(self):
         client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=0.999)
         timer = client.timer('timeit')
@@ -173,6 +289,442 @@ def test_couter_factory(self):
 
 
 
+class TestStatsdTags(unittest.TestCase):
+
+    def setUp(self):
+        # Moneky patch statsd socket for testing
+        statsd.socket = mock_udp_socket
+
+    def test_tags(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        client.incr('buck', 1, tags={'region': 'x', 'env': 'prod'})
+        self.assertEqual(client._socket.data, b'buck:1|c|#env:prod,region:x')
+        client.gauge('buck', 5, tags=['env:prod', ('host', 'a'), 'canary'])
+        self.assertEqual(client._socket.data, b'buck:5|g|#canary,env:prod,host:a')
+        client.timing('buck', 100, tags=('env:prod',))
+        self.assertEqual(client._socket.data, b'buck:100|ms|#env:prod')
+        client.decr('buck', 1)
+        self.assertEqual(client._socket.data, b'buck:-1|c')
+
+    def test_sample_rate_and_tags(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='app', sample_rate=0.999)
+        client.incr('buck', 1, tags=['env:prod'])
+        self.assertEqual(client._socket.data, b'app.buck:1|c|@0.999|#env:prod')
+
+    def test_constant_tags(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     constant_tags=['env:prod', 'region:x'])
+        client.incr('buck')
+        self.assertEqual(client._socket.data, b'buck:1|c|#env:prod,region:x')
+        client.incr('buck', tags={'region': 'y', 'host': 'a'})
+        self.assertEqual(client._socket.data, b'buck:1|c|#env:prod,host:a,region:y')
+
+    def test_invalid_chars(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        client.incr('buck', tags={'path': '/a,b|c#d e'})
+        self.assertEqual(client._socket.data, b'buck:1|c|#path:/a_b_c_d_e')
+
+    def test_cache(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     tag_cache_size=2)
+        suffix = client._tag_suffix(('env:prod',))
+        self.assertTrue(client._tag_suffix(('env:prod',)) is suffix)
+        client._tag_suffix({'env': 'dev'})
+        client._tag_suffix(['env:prod'])
+        client._tag_suffix(['env:test'])
+        self.assertEqual(set(client._tag_cache) | set(client._tag_cache_old),
+                         set([('env:prod',), ('env:test',)]))
+
+    def test_set_dedup_by_tags(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60)
+        client.set('users', 'u1', tags=['env:prod'])
+        client._socket.data = None
+        client.set('users', 'u1', tags=['env:dev'])
+        self.assertEqual(client._socket.data, b'users:u1|s|#env:dev')
+        client._socket.data = None
+        client.set('users', 'u1', tags=['env:prod'])
+        self.assertEqual(client._socket.data, None)
+
+    def test_unhashable_tags(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     set_dedup_window=60)
+        client.incr('buck', tags=[['env', 'prod']])
+        self.assertEqual(client._socket.data, b'buck:1|c|#env:prod')
+        client.incr('buck', tags={'hosts': ['a', 'b']})
+        self.assertTrue(client._socket.data.startswith(b'buck:1|c|#hosts:'))
+        client.set('users', 'u1', tags=[['env', 'prod']])
+        self.assertEqual(client._socket.data, b'users:u1|s|#env:prod')
+        client._socket.data = None
+        client.set('users', 'u1', tags=[['env', 'prod']])
+        self.assertEqual(client._socket.data, None)
+
+    def test_single_string_tag(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        client.incr('buck', tags='env:prod')
+        self.assertEqual(client._socket.data, b'buck:1|c|#env:prod')
+        client.incr('buck', tags=u'canary')
+        self.assertEqual(client._socket.data, b'buck:1|c|#canary')
+
+    def test_non_ascii_tags(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        client.incr('buck', tags={'k': u'caf\xe9'.encode('utf8')})
+        self.assertEqual(client._socket.data, u'buck:1|c|#k:caf\xe9'.encode('utf8'))
+        client.incr('buck', tags={u'caf\xe9': u'th\xe9'})
+        self.assertEqual(client._socket.data, u'buck:1|c|#caf\xe9:th\xe9'.encode('utf8'))
+
+    def test_counter_and_timer(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        counter = client.counter('counted', tags=['env:prod'])
+        counter += 1
+        self.assertEqual(client._socket.data, b'counted:1|c|#env:prod')
+        timer = client.timer('timeit', tags=['env:prod'])
+        with timer:
+            pass
+        self.assertTrue(client._socket.data.startswith(b'timeit.total:'))
+        self.assertTrue(client._socket.data.endswith(b'|ms|#env:prod'))
+        timer = client.timer('timeit', deferred=True, tags=['env:prod'])
+        with timer:
+            timer.split('lap')
+        for stat in client._socket.data.split(b'\n'):
+            self.assertTrue(stat.endswith(b'|ms|#env:prod'))
+
+
+class TestStatsdSpool(unittest.TestCase):
+
+    def setUp(self):
+        # Moneky patch statsd socket for testing
+        statsd.socket = mock_udp_socket
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'spool')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_append_pop(self):
+        spool = statsd.StatsdSpool(self._path, size=64)
+        self.assertEqual(spool.pop(), None)
+        spool.append(b'buck:1|c')
+        spool.append(b'buck:2|c')
+        self.assertEqual(spool.pop(), b'buck:1|c')
+        self.assertEqual(spool.pop(), b'buck:2|c')
+        self.assertEqual(spool.pop(), None)
+        self.assertEqual(spool.used, 0)
+
+    def test_overwrite_oldest(self):
+        spool = statsd.StatsdSpool(self._path, size=64)
+        stats = [('buck:%d|c' % i).encode('utf8') for i in range(20)]
+        for stat in stats:
+            spool.append(stat)
+        self.assertTrue(spool.dropped > 0)
+        kept = []
+        stat = spool.pop()
+        while stat is not None:
+            kept.append(stat)
+            stat = spool.pop()
+        self.assertEqual(kept, stats[spool.dropped:])
+
+    def test_reopen(self):
+        spool = statsd.StatsdSpool(self._path, size=64)
+        spool.append(b'buck:1|c')
+        spool.append(b'buck:2|c')
+        spool.pop()
+        spool.close()
+        spool = statsd.StatsdSpool(self._path, size=64)
+        self.assertEqual(spool.pop(), b'buck:2|c')
+        self.assertEqual(spool.pop(), None)
+
+    def test_client_spools_and_replays(self):
+        spool = statsd.StatsdSpool(self._path, size=1024, replay_rate=1000)
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     spool=spool)
+        sent = []
+        def mock_sendto_raise_error(data, addr):
+            raise socket.error
+        def mock_sendto(data, addr):
+            sent.append(data)
+        client._socket.sendto = mock_sendto_raise_error
+        client.incr('buck', 1)
+        client.incr('buck', 2)
+        self.assertEqual(sent, [])
+        client._socket.sendto = mock_sendto
+        spool._replayed_at -= 1
+        client.incr('buck', 3)
+        self.assertEqual(sent, [b'buck:3|c', b'buck:1|c', b'buck:2|c'])
+        self.assertEqual(spool.used, 0)
+
+    def test_replay_rate(self):
+        spool = statsd.StatsdSpool(self._path, size=1024, replay_rate=2)
+        for i in range(5):
+            spool.append(b'buck:1|c')
+        sent = []
+        spool._replayed_at -= 10
+        spool.replay(sent.append)
+        self.assertEqual(len(sent), 2)
+        spool.replay(sent.append)
+        self.assertEqual(len(sent), 2)
+
+    def test_replay_limit(self):
+        spool = statsd.StatsdSpool(self._path, size=1024, replay_rate=100)
+        for i in range(5):
+            spool.append(b'buck:1|c')
+        sent = []
+        spool._replayed_at -= 10
+        spool.replay(sent.append, limit=3)
+        self.assertEqual(len(sent), 3)
+
+    def test_replay_batch(self):
+        spool = statsd.StatsdSpool(self._path, size=1024, replay_rate=1000,
+                                   replay_batch=2)
+        for i in range(5):
+            spool.append(('buck:%d|c' % i).encode('utf8'))
+        sent = []
+        spool._replayed_at -= 1
+        spool.replay(sent.append)
+        self.assertEqual(sent, [b'buck:0|c', b'buck:1|c'])
+        spool.replay(sent.append)
+        self.assertEqual(len(sent), 4)
+
+    def test_replay_failure_puts_batch_back(self):
+        spool = statsd.StatsdSpool(self._path, size=1024, replay_rate=1000,
+                                   replay_batch=3)
+        for i in range(4):
+            spool.append(('buck:%d|c' % i).encode('utf8'))
+        def send(stat):
+            if stat == b'buck:1|c':
+                raise socket.error
+        spool._replayed_at -= 1
+        self.assertRaises(socket.error, spool.replay, send)
+        stats = [spool.pop() for _ in range(3)]
+        self.assertEqual(stats, [b'buck:3|c', b'buck:1|c', b'buck:2|c'])
+
+    def test_shared_file(self):
+        first = statsd.StatsdSpool(self._path, size=64)
+        second = statsd.StatsdSpool(self._path, size=64)
+        first.append(b'buck:1|c')
+        second.append(b'buck:2|c')
+        self.assertEqual(second.used, first.used)
+        self.assertEqual(second.pop(), b'buck:1|c')
+        first.append(b'buck:3|c')
+        self.assertEqual(first.pop(), b'buck:2|c')
+        self.assertEqual(second.pop(), b'buck:3|c')
+        self.assertEqual(first.pop(), None)
+
+    def test_forked_children_share_spool(self):
+        spool = statsd.StatsdSpool(self._path, size=65536)
+        children = []
+        for i in range(4):
+            pid = os.fork()
+            if not pid:
+                try:
+                    for j in range(500):
+                        spool.append(('buck.%d:%d|c' % (i, j)).encode('utf8'))
+                finally:
+                    os._exit(0)
+            children.append(pid)
+        for pid in children:
+            os.waitpid(pid, 0)
+        stats = []
+        stat = spool.pop()
+        while stat is not None:
+            stats.append(stat)
+            stat = spool.pop()
+        self.assertEqual(spool.dropped, 0)
+        self.assertEqual(len(stats), 2000)
+        for i in range(4):
+            own = [stat for stat in stats if stat.startswith(('buck.%d:' % i).encode('utf8'))]
+            self.assertEqual(own, [('buck.%d:%d|c' % (i, j)).encode('utf8')
+                                   for j in range(500)])
+
+
+class TestStatsdSharding(unittest.TestCase):
+
+    def setUp(self):
+        statsd.socket = socket.socket
+        self._sinks = []
+        for _ in range(3):
+            sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sink.bind(('127.0.0.1', 0))
+            sink.settimeout(1)
+            self._sinks.append(sink)
+        self._destinations = [sink.getsockname() for sink in self._sinks]
+
+    def tearDown(self):
+        for sink in self._sinks:
+            sink.close()
+
+    def _received(self, sink):
+        stats = []
+        sink.settimeout(0.1)
+        try:
+            while True:
+                stats.extend(sink.recv(65536).split(b'\n'))
+        except socket.timeout:
+            return stats
+
+    def test_ring_is_consistent(self):
+        ring = statsd.StatsdHashRing(self._destinations)
+        buckets = [('bucket%d' % i).encode('utf8') for i in range(1000)]
+        before = dict((bucket, ring.get_node(bucket)) for bucket in buckets)
+        self.assertEqual(len(set(before.values())), 3)
+
+        ring = statsd.StatsdHashRing(self._destinations[:2])
+        moved = [bucket for bucket in buckets if ring.get_node(bucket) != before[bucket]]
+        for bucket in moved:
+            self.assertEqual(before[bucket], self._destinations[2])
+
+    def test_ring_destination_strings(self):
+        ring = statsd.StatsdHashRing(['127.0.0.1:9999', 'localhost'])
+        self.assertEqual(set(ring._nodes), set([('127.0.0.1', 9999), ('localhost', 8125)]))
+
+    def test_send_to_shards(self):
+        client = statsd.StatsdClient(prefix='app', destinations=self._destinations)
+        ring = statsd.StatsdHashRing(self._destinations)
+        for i in range(30):
+            client.incr('bucket%d' % i)
+        received = 0
+        for sink in self._sinks:
+            for stat in self._received(sink):
+                bucket = stat.split(b':')[0]
+                self.assertTrue(bucket.startswith(b'app.bucket'))
+                self.assertEqual(ring.get_node(bucket), sink.getsockname())
+                received += 1
+        self.assertEqual(received, 30)
+
+    def test_batching(self):
+        client = statsd.StatsdClient(prefix='', destinations=self._destinations,
+                                     max_packet_size=512, flush_interval=60)
+        for i in range(30):
+            client.incr('bucket%d' % i)
+        self.assertEqual(sum(len(stats) for stats in client._buffers.values()), 30)
+        client.flush()
+        self.assertEqual(client._buffers, {})
+        received = []
+        for sink in self._sinks:
+            received.extend(self._received(sink))
+        self.assertEqual(sorted(received),
+                         sorted([('bucket%d:1|c' % i).encode('utf8') for i in range(30)]))
+
+    def test_batch_packet_size(self):
+        sink = self._sinks[0]
+        client = statsd.StatsdClient(prefix='', destinations=[sink.getsockname()],
+                                     max_packet_size=64, flush_interval=60)
+        for i in range(20):
+            client.incr('bucket', i)
+        packet = sink.recv(65536)
+        self.assertTrue(len(packet) <= 64)
+        self.assertTrue(packet.startswith(b'bucket:0|c\nbucket:1|c\n'))
+
+    def test_periodic_flush(self):
+        sink = self._sinks[0]
+        client = statsd.StatsdClient(prefix='', destinations=[sink.getsockname()],
+                                     max_packet_size=512, flush_interval=0.05)
+        client.incr('buck')
+        time.sleep(0.2)
+        self.assertEqual(client._buffers, {})
+        self.assertEqual(sink.recv(65536), b'buck:1|c')
+
+    def test_flush_at_exit(self):
+        sink = self._sinks[0]
+        client = statsd.StatsdClient(prefix='', destinations=[sink.getsockname()],
+                                     max_packet_size=512, flush_interval=60)
+        client.incr('buck')
+        statsd._flush_all()
+        self.assertEqual(sink.recv(65536), b'buck:1|c')
+
+    def test_set_destinations(self):
+        client = statsd.StatsdClient(prefix='', destinations=self._destinations[:1],
+                                     max_packet_size=512, flush_interval=60)
+        client.incr('buck')
+        client.set_destinations(self._destinations[1:2])
+        self.assertEqual(self._sinks[0].recv(65536), b'buck:1|c')
+        client.incr('buck')
+        client.flush()
+        self.assertEqual(self._sinks[1].recv(65536), b'buck:1|c')
+
+
+class TestStatsdCardinalityGuard(unittest.TestCase):
+
+    def setUp(self):
+        # Moneky patch statsd socket for testing
+        statsd.socket = mock_udp_socket
+
+    def test_drop(self):
+        guard = statsd.StatsdCardinalityGuard(2)
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None,
+                                     cardinality_guard=guard)
+        client.incr('buck1')
+        client.incr('buck2')
+        client.incr('buck3')
+        self.assertEqual(client._socket.data, b'buck2:1|c')
+        client.incr('buck1', 5)
+        self.assertEqual(client._socket.data, b'buck1:5|c')
+        self.assertEqual(guard.rejected, 1)
+
+    def test_overflow_bucket(self):
+        guard = statsd.StatsdCardinalityGuard(1, overflow_bucket='overflow')
+        client = statsd.StatsdClient('localhost', 8125, prefix='app', sample_rate=None,
+                                     cardinality_guard=guard)
+        client.incr('buck1')
+        client.timing('buck2', 100)
+        self.assertEqual(client._socket.data, b'app.overflow:100|ms')
+        self.assertEqual(guard.rejected, 1)
+
+    def test_estimate(self):
+        guard = statsd.StatsdCardinalityGuard(10)
+        for i in range(5000):
+            guard.admit(('request.%d' % i).encode('utf8'))
+        self.assertEqual(len(guard._allowed), 10)
+        self.assertEqual(guard.rejected, 4990)
+        self.assertTrue(abs(guard.estimate() - 5000) < 500)
+        guard.reset()
+        self.assertEqual(guard.estimate(), 0)
+        self.assertEqual(guard.rejected, 0)
+
+    def test_concurrent_admit(self):
+        guard = statsd.StatsdCardinalityGuard(100)
+        buckets = [[('bucket.%d' % ((i * 7 + offset) % 1000)).encode('utf8')
+                    for i in range(2000)] for offset in range(8)]
+        def admit(buckets):
+            for bucket in buckets:
+                guard.admit(bucket)
+        threads = [threading.Thread(target=admit, args=(own,)) for own in buckets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(guard._allowed), 100)
+        self.assertEqual(guard.rejected, sum(1 for own in buckets for bucket in own
+                                             if bucket not in guard._allowed))
+
+    def test_report_rejected(self):
+        guard = statsd.StatsdCardinalityGuard(1, rejected_bucket='statsd.rejected',
+                                              report_interval=60)
+        client = statsd.StatsdClient('localhost', 8125, prefix='app', sample_rate=None,
+                                     cardinality_guard=guard, constant_tags=['env:prod'])
+        sent = []
+        client._socket.sendto = lambda data, addr: sent.append(data)
+        client.incr('buck1')
+        client.incr('buck2')
+        client.incr('buck3')
+        self.assertEqual(sent, [b'app.buck1:1|c|#env:prod',
+                                b'app.statsd.rejected:1|c|#env:prod'])
+        guard._report_at = 0
+        client.flush()
+        self.assertEqual(sent[-1], b'app.statsd.rejected:1|c|#env:prod')
+        client.flush()
+        self.assertEqual(len(sent), 3)
+
+    def test_init_statsd(self):
+        statsd.init_statsd({'STATSD_CARDINALITY_LIMIT': 5,
+                            'STATSD_CARDINALITY_OVERFLOW_BUCKET': 'overflow'})
+        self.assertEqual(statsd._statsd._guard._limit, 5)
+        self.assertEqual(statsd._statsd._guard._overflow, b'overflow')
+        statsd.STATSD_CARDINALITY_LIMIT = None
+        statsd.STATSD_CARDINALITY_OVERFLOW_BUCKET = None
+        statsd.init_statsd()
+
+
 class TestStatsdCounter(unittest.TestCase):
 
     def setUp(self):
@@ -199,6 +751,10 @@ class TestStatsdTimer(unittest.TestCase):
     def setUp(self):
         # Moneky patch statsd socket for testing
         statsd.socket = mock_udp_socket
+        self._time = time.time
+
+    def tearDown(self):
+        time.time = self._time
 
     def test_startstop(self):
         timer = statsd.StatsdTimer('timeit', statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None))
@@ -237,6 +793,64 @@ def test_with(self):
         self.assertTrue(timer._client._socket.data.startswith(b'timeit.total:2'))
         self.assertTrue(timer._client._socket.data.endswith(b'|ms'))
 
+    def test_deferred(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        sent = []
+        client._socket.sendto = lambda data, addr: sent.append(data)
+        timer = client.timer('timeit', deferred=True)
+        timer.start()
+        time.sleep(0.1)
+        timer.split('stage1')
+        timer.split('stage2')
+        self.assertEqual(sent, [])
+        timer.stop()
+        self.assertEqual(len(sent), 1)
+        stats = sent[0].split(b'\n')
+        self.assertEqual([stat.split(b':')[0] for stat in stats],
+                         [b'timeit.stage1', b'timeit.stage2', b'timeit.total'])
+        self.assertTrue(stats[0].startswith(b'timeit.stage1:1'))
+        for stat in stats:
+            self.assertTrue(stat.endswith(b'|ms'))
+
+    def test_deferred_many_splits(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        sent = []
+        client._socket.sendto = lambda data, addr: sent.append(data)
+        timer = client.timer('a.fairly.long.timer.bucket', deferred=True)
+        with timer:
+            for i in range(200):
+                timer.split('split%d' % i)
+        self.assertTrue(len(sent) > 1)
+        for packet in sent:
+            self.assertTrue(len(packet) <= 1432)
+        stats = b'\n'.join(sent).split(b'\n')
+        self.assertEqual(len(stats), 201)
+        self.assertTrue(stats[-1].startswith(b'a.fairly.long.timer.bucket.total:'))
+
+    def test_deferred_with_exception(self):
+        client = statsd.StatsdClient('localhost', 8125, prefix='', sample_rate=None)
+        timer = statsd.StatsdTimer('timeit', client, deferred=True)
+        try:
+            with timer:
+                timer.split('lap')
+                raise ValueError()
+        except ValueError:
+            pass
+        stats = client._socket.data.split(b'\n')
+        self.assertEqual([stat.split(b':')[0] for stat in stats],
+                         [b'timeit.lap', b'timeit.total-except'])
+
+    def test_disabled_skips_clock(self):
+        def mock_time_not_called():
+            raise AssertionError('time.time() called on a disabled timer')
+        timer = statsd.StatsdTimer('timeit', statsd.NullStatsdClient())
+        time.time = mock_time_not_called
+        with timer:
+            timer.split('lap')
+        counter = statsd.StatsdCounter('counted', statsd.NullStatsdClient())
+        counter += 1
+        counter -= 1
+
 if __name__ == '__main__':
     unittest.main()
 